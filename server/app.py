@@ -1,18 +1,104 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, g, request, jsonify, render_template_string
 import threading
+import time
 from datetime import datetime
 import json
 import os
+import logging
+import math
 import random
 
+from broadcast import Broadcaster
+from district_stats import DistrictStats
+from districts_file import DistrictsFile
+from geometry import DistrictIndex, DistrictRaster, changed_regions, point_in_polygon, simplify_districts
+from history import LocationHistory, parse_time
+from logging_setup import configure_logging
+from metrics import FAST_BUCKETS, Registry, TimedLock
+from responses import PreparedBody
+from store import UserLocation, make_location_store
+from wire import COLUMNAR, JSON, POLYLINE, columnar_locations, polyline_districts
+
 app = Flask(__name__)
+log = configure_logging()
+
+# Prometheus metrics served at GET /metrics; each worker process keeps its own
+metrics = Registry(prefix='location_tracker_')
+REQUESTS = metrics.counter('http_requests', 'HTTP requests by route, method and status',
+                           ('route', 'method', 'status'))
+REQUEST_SECONDS = metrics.histogram('http_request_duration_seconds', 'Time to build a response, by route',
+                                    ('route', 'method'))
+LOOKUP_SECONDS = metrics.histogram('get_district_duration_seconds', 'Time per get_district lookup',
+                                   buckets=FAST_BUCKETS)
+LOOKUP_POLYGONS = metrics.histogram('get_district_polygons_tested',
+                                    'Polygons ray-cast per lookup (0 when the raster answers)',
+                                    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64))
+LOCK_WAIT_SECONDS = metrics.histogram('lock_wait_seconds', 'Time spent waiting for location store locks',
+                                      ('lock',), FAST_BUCKETS)
+LOCK_HOLD_SECONDS = metrics.histogram('lock_hold_seconds', 'Time location store locks are held',
+                                      ('lock',), FAST_BUCKETS)
+DISTRICTS_SAVE_SECONDS = metrics.histogram('districts_save_duration_seconds',
+                                           'Time to write districts.json, by result', ('result',))
+USERS_REMOVED = metrics.counter('users_removed', 'Users dropped for going silent or for MAX_USERS')
+metrics.gauge('active_users', 'Users with a stored location', lambda: len(location_store))
+metrics.gauge('districts', 'Districts in the current map', lambda: len(DISTRICTS))
+metrics.gauge('districts_generation', 'Generation of the district map this worker holds',
+              lambda: districts_file.generation)
+metrics.gauge('stream_subscribers', 'Connected /api/stream clients', lambda: len(broadcaster))
+
+def timed_lock(name, lock):
+    return TimedLock(lock, LOCK_WAIT_SECONDS.labels(name), LOCK_HOLD_SECONDS.labels(name))
+
+def record_districts_save(seconds, error):
+    DISTRICTS_SAVE_SECONDS.labels('error' if error else 'ok').observe(seconds)
+
+# Thread-safe storage: latest location per user, in memory (lock-striped by
+# username) or shared between worker processes through SQLite
+location_store = make_location_store(timed_lock)
+
+# Entries and exits per district, rolled up by minute and hour for GET /api/districts/stats
+district_stats = DistrictStats(location_store.district_counts,
+                               minutes=int(os.environ.get('DISTRICT_STATS_MINUTES', 60)),
+                               hours=int(os.environ.get('DISTRICT_STATS_HOURS', 24)))
 
-# Thread-safe storage
-location_data = {}
-data_lock = threading.Lock()
+# Append-only log of every accepted fix; set HISTORY_DIR to an empty string to disable
+HISTORY_DIR = os.environ.get('HISTORY_DIR', os.path.join(os.path.dirname(__file__), 'history'))
+location_history = LocationHistory(HISTORY_DIR) if HISTORY_DIR else None
+MAX_HISTORY_POINTS = 10000
 
-# File path for storing districts
+# Upper bound on how long GET /api/user_districts?wait= may hold a request
+MAX_LONG_POLL_SECONDS = 30
+
+# Push channel for GET /api/stream; each client gets a bounded queue that
+# drops its oldest events when the client falls behind
+broadcaster = Broadcaster(queue_size=int(os.environ.get('STREAM_QUEUE_SIZE', 256)))
+STREAM_KEEPALIVE_SECONDS = 15
+
+# File path for storing districts; saves are written atomically in the background
 DISTRICTS_FILE = os.path.join(os.path.dirname(__file__), 'districts.json')
+districts_file = DistrictsFile(DISTRICTS_FILE, on_write=record_districts_save)
+
+# Workers pick up districts.json changes made by other processes by checking
+# the file's stamp and generation at most this often (seconds)
+DISTRICTS_CHECK_INTERVAL = float(os.environ.get('DISTRICTS_CHECK_INTERVAL', 1.0))
+districts_checked_at = 0.0
+
+# Simplification tolerances (degrees) for GET /api/districts?lod=1..n; lod=0 is exact
+DISTRICT_LOD_TOLERANCES = [float(t) for t in
+                           os.environ.get('DISTRICT_LOD_TOLERANCES', '0.00002,0.0001,0.0005').split(',') if t]
+# Lookups test a ring simplified to this tolerance first, and the exact polygon near its edges
+DISTRICT_COARSE_TOLERANCE = float(os.environ.get('DISTRICT_COARSE_TOLERANCE', 0.0001))
+# Memory for the inside/outside/boundary raster that answers most lookups outright; 0 disables it
+DISTRICT_RASTER_BYTES = int(os.environ.get('DISTRICT_RASTER_BYTES', 1 << 20))
+# Users stay in their last district until they are this far outside it (meters); 0 disables it
+DISTRICT_HYSTERESIS_METERS = float(os.environ.get('DISTRICT_HYSTERESIS_METERS', 0))
+# Most transitions GET /api/transitions returns at once
+MAX_TRANSITIONS = 1000
+# Clusters from GET /api/user_clusters span about this many map pixels at the requested zoom
+CLUSTER_PIXELS = 64
+MAX_CLUSTER_ZOOM = 22
+# How often users silent for USER_TTL_SECONDS are swept out (and, with LOCATION_DB, old tombstones trimmed)
+EXPIRY_INTERVAL = min(60.0, max(1.0, location_store.ttl / 10)) if location_store.ttl else 60.0
 
 # Default polygon-based districts for Point Loma area
 DEFAULT_DISTRICTS = {
@@ -45,74 +131,263 @@ DEFAULT_DISTRICTS = {
 def load_districts():
     """Load districts from file, or use defaults if file doesn't exist"""
     try:
-        if os.path.exists(DISTRICTS_FILE):
-            with open(DISTRICTS_FILE, 'r') as f:
-                districts = json.load(f)
-                print(f"Loaded {len(districts)} districts from {DISTRICTS_FILE}")
-                return districts
+        districts = districts_file.load()
+        if districts is not None:
+            log.info(f"Loaded {len(districts)} districts",
+                     extra={'path': DISTRICTS_FILE, 'generation': districts_file.generation})
+            return districts
         else:
-            print("No districts file found, using defaults")
+            log.info("No districts file found, using defaults")
             return DEFAULT_DISTRICTS.copy()
     except Exception as e:
-        print(f"Error loading districts file: {e}")
-        print("Using default districts")
+        log.error(f"Error loading districts file, using defaults: {e}", extra={'path': DISTRICTS_FILE})
         return DEFAULT_DISTRICTS.copy()
 
 def save_districts(districts):
-    """Save districts to file"""
+    """Queue districts to be written to file; False if the file can't currently be written"""
+    if districts_file.error is not None:
+        log.error(f"Error saving districts file: {districts_file.error}", extra={'path': DISTRICTS_FILE})
+        # Still queue this map; the writer keeps retrying the latest one
+        districts_file.save(districts)
+        return False
+    districts_file.save(districts)
+    log.info(f"Queued {len(districts)} districts for saving", extra={'path': DISTRICTS_FILE})
+    return True
+
+def set_districts(districts):
+    """Swap in a new district map together with its spatial index and serialized form"""
+    global DISTRICTS, DISTRICT_INDEX, DISTRICTS_BODIES
+    # Build the index before publishing it; get_district only reads DISTRICT_INDEX,
+    # so a lookup always sees a map and an index that belong together
+    index = DistrictIndex(districts, coarse_tolerance=DISTRICT_COARSE_TOLERANCE)
+    for name, error in index.errors.items():
+        log.warning(f"Error indexing district '{name}': {error}", extra={'district': name})
+    # GET /api/districts serves these as-is, so each tier and format is serialized once per change.
+    # Simplified tiers are filled in off the request path; lod=0 stands in until they are ready
+    bodies = [prepare_district_bodies(districts)] + [None] * len(DISTRICT_LOD_TOLERANCES)
+    DISTRICTS, DISTRICT_INDEX, DISTRICTS_BODIES = districts, index, bodies
+    # Likewise the raster; lookups take the exact polygon path until it is attached
+    if DISTRICT_RASTER_BYTES > 0 and index.extent:
+        threading.Thread(target=build_raster, args=(index,), name='district-raster', daemon=True).start()
+    if DISTRICT_LOD_TOLERANCES:
+        threading.Thread(target=build_lod_tiers, args=(districts, bodies), name='lod-tiers', daemon=True).start()
+
+def build_raster(index):
+    """Build index's raster and attach it, unless a newer map has replaced index by then"""
     try:
-        with open(DISTRICTS_FILE, 'w') as f:
-            json.dump(districts, f, indent=2)
-        print(f"Saved {len(districts)} districts to {DISTRICTS_FILE}")
-        return True
+        raster = DistrictRaster(index, DISTRICT_RASTER_BYTES)
     except Exception as e:
-        print(f"Error saving districts file: {e}")
+        log.exception(f"Error building district raster: {e}")
+        return
+    if DISTRICT_INDEX is not index:
+        return
+    index.raster = raster
+    log.info(f"Built {raster.rows}x{raster.cols} district raster", extra=raster.stats())
+
+def build_lod_tiers(districts, bodies):
+    """Fill in the simplified tiers of bodies, giving up once a newer map has replaced it"""
+    for lod, tolerance in enumerate(DISTRICT_LOD_TOLERANCES, 1):
+        if DISTRICTS_BODIES is not bodies:
+            return
+        try:
+            bodies[lod] = prepare_district_bodies(simplify_districts(districts, tolerance))
+        except Exception as e:
+            log.exception(f"Error simplifying districts: {e}", extra={'tolerance': tolerance})
+            return
+
+def prepare_district_bodies(districts):
+    return {
+        JSON: PreparedBody(json.dumps(districts, separators=(',', ':'), sort_keys=True)),
+        POLYLINE: PreparedBody(json.dumps(polyline_districts(districts), separators=(',', ':')),
+                               mimetype=POLYLINE),
+    }
+
+def refresh_districts():
+    """Reload districts.json if another process saved a newer generation of it"""
+    global districts_checked_at
+    now = time.monotonic()
+    if now - districts_checked_at < DISTRICTS_CHECK_INTERVAL:
         return False
+    districts_checked_at = now
+    if not districts_file.changed():
+        return False
+    
+    old_index = DISTRICT_INDEX
+    set_districts(load_districts())
+    broadcaster.publish('districts', {'count': len(DISTRICTS)})
+    # A shared store's users were already reclassified by the process that saved
+    # the file; this process's own in-memory users still need it
+    if not location_store.shared:
+        reclassify_users(old_index, DISTRICT_INDEX)
+    return True
 
 # Load districts at startup
-DISTRICTS = load_districts()
+set_districts(load_districts())
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # Label by URL rule, not path, so unknown paths can't create new series
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_SECONDS.labels(route, request.method).observe(time.perf_counter() - started)
+    REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+    return response
+
+@app.before_request
+def sync_shared_state():
+    refresh_districts()
+    start_background_threads()
 
-def point_in_polygon(lat, lng, polygon):
+def start_background_threads():
+    """Start whichever of the relay and expiry threads this process's store needs, once"""
+    if location_store.shared:
+        # District stats count every process's transitions through the relay
+        start_relay()
+    # MAX_USERS alone evicts as users are stored; only a shared store's tombstones need sweeping too
+    if location_store.ttl or (location_store.shared and location_store.max_users):
+        start_expiry()
+
+def get_district(lat, lng, previous=None):
     """
-    Improved ray casting algorithm to determine if a point is inside a polygon.
-    polygon: list of [lat, lng] coordinates
+    Determine which district a location belongs to using polygon containment.
+
+    previous is the user's last district, if known: the lookup starts there,
+    and with DISTRICT_HYSTERESIS_METERS the user keeps it while the point
+    stays within that distance of it.
     """
-    if len(polygon) < 3:
-        return False
+    index = DISTRICT_INDEX
+    hint = index.positions.get(previous)
     
-    x, y = lng, lat
-    n = len(polygon)
-    inside = False
-    
-    # Use the standard ray casting algorithm
-    j = n - 1
-    for i in range(n):
-        xi, yi = polygon[i][1], polygon[i][0]  # lng, lat
-        xj, yj = polygon[j][1], polygon[j][0]  # lng, lat
-        
-        if ((yi > y) != (yj > y)) and (x < (xj - xi) * (y - yi) / (yj - yi) + xi):
-            inside = not inside
-        j = i
+    try:
+        started = time.perf_counter()
+        district_name, tested = index.locate(lat, lng, hint)
+        if hint is not None and district_name != previous and DISTRICT_HYSTERESIS_METERS > 0 and \
+                index.within(hint, lat, lng, DISTRICT_HYSTERESIS_METERS):
+            district_name = previous
+        LOOKUP_SECONDS.observe(time.perf_counter() - started)
+        LOOKUP_POLYGONS.observe(tested)
+        # The per-district trace is only built when someone is listening for it
+        if log.isEnabledFor(logging.DEBUG):
+            for name, inside in index.trace(lat, lng):
+                log.debug(f"District '{name}': {'INSIDE' if inside else 'outside'}",
+                          extra={'lat': lat, 'lng': lng, 'district': name})
+            log.debug(f"Point ({lat}, {lng}) resolved to {district_name or 'Outside Districts'}",
+                      extra={'lat': lat, 'lng': lng})
+    except Exception as e:
+        log.warning(f"Error checking point ({lat}, {lng}): {e}")
+        district_name = None
     
-    return inside
+    if district_name is not None:
+        return district_name
+    return "Outside Districts"
+
+def publish_locations(changed, seq):
+    """Push changed user locations ({username: UserLocation}) to stream clients"""
+    if location_store.shared:
+        # Other processes write too, so stream events come from relay_changes instead
+        return
+    if changed:
+        changed = {username: record.to_dict() for username, record in changed.items()}
+        broadcaster.publish('location', {'seq': seq, 'full': False, 'changed': changed, 'removed': []})
+
+def publish_transitions(transitions):
+    """Count district transitions in the rollups and push them to stream clients"""
+    try:
+        district_stats.record(transitions)
+    except Exception as e:
+        log.exception(f"Error recording district stats: {e}")
+    broadcaster.publish('transition', {'transitions': transitions})
 
-def get_district(lat, lng):
-    """Determine which district a location belongs to using polygon containment"""
-    print(f"Checking point ({lat}, {lng}) against {len(DISTRICTS)} districts")
+def store_transitions(transitions):
+    # A shared store's transitions, from every process, arrive through relay_changes instead
+    if not location_store.shared:
+        publish_transitions(transitions)
+
+location_store.on_transitions = store_transitions
+
+def store_removals(usernames, seq):
+    """Tell stream clients about users that expired or were evicted"""
+    USERS_REMOVED.inc(len(usernames))
+    # As with locations, a shared store's removals reach clients through relay_changes
+    if not location_store.shared:
+        broadcaster.publish('location', {'seq': seq, 'full': False, 'changed': {}, 'removed': list(usernames)})
+
+location_store.on_removed = store_removals
+
+def record_history(items):
+    """Append accepted (username, UserLocation) fixes to the history log"""
+    if location_history is None:
+        return
+    try:
+        now = time.time()
+        location_history.append([
+            (username, parse_time(record.timestamp) or now, float(record.latitude),
+             float(record.longitude), None if record.district == "Outside Districts" else record.district)
+            for username, record in items
+        ])
+    except Exception as e:
+        # History is best effort; the fix itself was already accepted
+        log.exception(f"Error appending location history: {e}")
+
+def reclassify_users(old_index, new_index):
+    """
+    Re-run get_district for users whose point may have changed district.
+
+    Only points inside the bounding boxes of added, removed, reshaped or
+    reordered districts are re-tested. The work runs against a lock-free
+    snapshot of the store; results are then swapped in one user at a time,
+    skipping anyone who posted a new fix in the meantime (their record was
+    already classified against the new index).
+    """
+    regions = changed_regions(old_index, new_index)
+    if not regions:
+        return 0
     
-    for district_name, polygon in DISTRICTS.items():
-        try:
-            is_inside = point_in_polygon(lat, lng, polygon)
-            print(f"  District '{district_name}': {'INSIDE' if is_inside else 'outside'}")
-            if is_inside:
-                print(f"Point ({lat}, {lng}) found in district: {district_name}")
-                return district_name
-        except Exception as e:
-            print(f"Error checking district '{district_name}': {e}")
+    snapshot = location_store.items()
+    
+    updates = []
+    for username, record in snapshot:
+        lat, lng = record.latitude, record.longitude
+        if not any(r[0] <= lat <= r[2] and r[1] <= lng <= r[3] for r in regions):
             continue
+        district = get_district(lat, lng)
+        if district != record.district:
+            updates.append((username, record, record.with_district(district)))
     
-    print(f"Point ({lat}, {lng}) is outside all districts")
-    return "Outside Districts"
+    changed, seq = {}, None
+    for username, record, updated in updates:
+        # Records are replaced, never mutated, so identity means "unchanged"
+        replaced_seq = location_store.replace_if(username, record, updated)
+        if replaced_seq is not None:
+            seq = replaced_seq
+            changed[username] = updated
+    publish_locations(changed, seq)
+    
+    log.info("Reclassified users after district change",
+             extra={'regions': len(regions), 'users': len(snapshot), 'changed': len(updates)})
+    return len(updates)
+
+def store_location(username, latitude, longitude, timestamp):
+    """Classify and store one fix, then publish and log it; returns its district"""
+    # Clients may send any JSON value as a username; the store keys users by string
+    username = str(username)
+    # Determine district using polygon containment, starting from the user's last one
+    previous = location_store.get(username)
+    district = get_district(latitude, longitude, previous.district if previous else None)
+    
+    record = UserLocation(latitude, longitude, timestamp, district)
+    seq = location_store.put(username, record)
+    publish_locations({username: record}, seq)
+    record_history([(username, record)])
+    
+    log.info("Received location", extra={'username': username, 'lat': latitude,
+                                         'lng': longitude, 'district': district})
+    return district
 
 @app.route('/api/location', methods=['POST'])
 def receive_location():
@@ -125,40 +400,363 @@ def receive_location():
         
         if latitude is None or longitude is None:
             return jsonify({'error': 'Missing latitude or longitude'}), 400
+        if not (valid_coordinate(latitude) and valid_coordinate(longitude)):
+            return jsonify({'error': 'Latitude and longitude must be finite numbers'}), 400
         
-        # Determine district using polygon containment
-        district = get_district(latitude, longitude)
+        district = store_location(username, latitude, longitude, timestamp)
+        return jsonify({'status': 'success', 'district': district})
+    
+    except Exception as e:
+        log.exception(f"Error processing location: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def valid_coordinate(value):
+    """
+    True for a finite JSON number. Rejects strings, booleans and lists, and the
+    Infinity, NaN and out-of-range integer literals (1e400 parses as an int)
+    that Flask's JSON parser lets through.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+def parse_location_batch():
+    """Read a batch of fixes from a JSON array or an NDJSON body"""
+    body = request.get_data(as_text=True)
+    if 'ndjson' in (request.content_type or '') or not body.lstrip().startswith('['):
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    return json.loads(body)
+
+@app.route('/api/locations/batch', methods=['POST'])
+def receive_location_batch():
+    """Accept many fixes at once and classify them in a single vectorized pass"""
+    try:
+        try:
+            fixes = parse_location_batch()
+        except ValueError as e:
+            return jsonify({'error': f'Invalid batch body: {e}'}), 400
+        if not isinstance(fixes, list):
+            return jsonify({'error': 'Expected a JSON array or NDJSON of fixes'}), 400
         
-        with data_lock:
-            location_data[username] = {
-                'latitude': latitude,
-                'longitude': longitude,
-                'timestamp': timestamp,
-                'district': district
-            }
+        for i, fix in enumerate(fixes):
+            if not isinstance(fix, dict) or fix.get('latitude') is None or fix.get('longitude') is None:
+                return jsonify({'error': f'Missing latitude or longitude in fix {i}'}), 400
+            if not (valid_coordinate(fix['latitude']) and valid_coordinate(fix['longitude'])):
+                return jsonify({'error': f'Latitude and longitude must be finite numbers in fix {i}'}), 400
+            fix['username'] = str(fix.get('username', 'unknown'))
         
-        print(f"Received location from {username}: {latitude}, {longitude} in {district}")
-        return jsonify({'status': 'success', 'district': district})
+        index = DISTRICT_INDEX
+        district_ids = index.classify([fix['latitude'] for fix in fixes],
+                                      [fix['longitude'] for fix in fixes])
+        districts = [index.names[i] if i >= 0 else "Outside Districts" for i in district_ids]
+        if DISTRICT_HYSTERESIS_METERS > 0:
+            apply_hysteresis(index, fixes, districts)
+        
+        now = datetime.now().isoformat()
+        # Fixes are applied in order, so the last one per user wins
+        items = [(fix['username'],
+                  UserLocation(fix['latitude'], fix['longitude'], fix.get('timestamp', now), district))
+                 for fix, district in zip(fixes, districts)]
+        seq = location_store.put_many(items)
+        changed = dict(items)
+        if location_store.max_users:
+            # A batch bigger than MAX_USERS evicts some of its own users, already announced as removed
+            changed = {username: record for username, record in changed.items()
+                       if location_store.get(username) is not None}
+        publish_locations(changed, seq)
+        record_history(items)
+        
+        log.info("Received location batch", extra={'fixes': len(fixes)})
+        return jsonify({'status': 'success', 'districts': districts})
     
     except Exception as e:
-        print(f"Error processing location: {e}")
+        log.exception(f"Error processing location batch: {e}")
         return jsonify({'error': str(e)}), 500
 
+def apply_hysteresis(index, fixes, districts):
+    """Keep each user in their previous district while near it, replaying a batch's fixes in order"""
+    previous = {}
+    for i, fix in enumerate(fixes):
+        username = fix['username']
+        if username not in previous:
+            record = location_store.get(username)
+            previous[username] = record.district if record else None
+        hint = index.positions.get(previous[username])
+        if hint is not None and districts[i] != previous[username] and \
+                index.within(hint, float(fix['latitude']), float(fix['longitude']), DISTRICT_HYSTERESIS_METERS):
+            districts[i] = previous[username]
+        previous[username] = districts[i]
+
+@app.route('/api/transitions', methods=['GET'])
+def get_transitions():
+    """
+    Return district transitions (a user entering, leaving or moving between districts).
+
+    ?since=<id> returns only transitions after that id and ?user= only one
+    user's; ?limit= caps the page. Clients pass the returned id as the next
+    since. truncated means transitions after since were already dropped.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', MAX_TRANSITIONS, type=int), MAX_TRANSITIONS)
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    return jsonify(location_store.transitions_since(since, request.args.get('user'), limit))
+
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    """
+    Return one user's recorded fixes, oldest first.
+
+    ?user= is required; ?from= and ?to= bound the fix timestamps and accept
+    ISO 8601 or epoch seconds; ?limit= caps the number of points.
+    """
+    if location_history is None:
+        return jsonify({'error': 'Location history is disabled'}), 404
+    
+    username = request.args.get('user')
+    if not username:
+        return jsonify({'error': 'Missing user parameter'}), 400
+    start, end = parse_time(request.args.get('from')), parse_time(request.args.get('to'))
+    for name in ('from', 'to'):
+        if request.args.get(name) and parse_time(request.args.get(name)) is None:
+            return jsonify({'error': f'Invalid {name} timestamp'}), 400
+    limit = min(request.args.get('limit', MAX_HISTORY_POINTS, type=int), MAX_HISTORY_POINTS)
+    
+    points = location_history.query(username, start, end, limit)
+    return jsonify({'user': username, 'points': points})
+
 @app.route('/api/user_districts', methods=['GET'])
 def get_user_districts():
-    with data_lock:
-        return jsonify(dict(location_data))
+    """
+    Return user locations.
+
+    Without parameters this is the full {username: location} snapshot. With
+    ?since=<seq> only users changed after that sequence number are returned,
+    plus the usernames removed since then; ?wait=<seconds> long-polls until
+    something changes. Clients pass the returned seq as the next since.
+
+    ?bbox=minLat,minLng,maxLat,maxLng and ?district=<name> limit either form
+    to matching users; in the feed, users that left the filter count as removed.
+    """
+    columnar = request.accept_mimetypes.best_match([JSON, COLUMNAR]) == COLUMNAR
+    try:
+        bbox, district = parse_user_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    since = request.args.get('since', type=int)
+    if since is None:
+        snapshot = location_store.snapshot(bbox, district)
+        return location_response(columnar_locations(snapshot) if columnar else snapshot, columnar)
+    
+    wait = long_poll_wait(request.args.get('wait'))
+    feed = location_store.changes_since(since, wait, bbox, district)
+    if columnar:
+        feed['changed'] = columnar_locations(feed['changed'])
+    return location_response(feed, columnar)
+
+def long_poll_wait(value):
+    """Clamp a ?wait= value to 0..MAX_LONG_POLL_SECONDS; missing, malformed or non-finite means 0"""
+    try:
+        wait = float(value or 0)
+    except ValueError:
+        return 0.0
+    if not math.isfinite(wait):
+        return 0.0
+    return min(max(wait, 0.0), MAX_LONG_POLL_SECONDS)
+
+def parse_user_filters(args):
+    """Read the optional ?bbox= and ?district= filters from query arguments; raises ValueError"""
+    return parse_bbox(args), args.get('district') or None
+
+def parse_bbox(args):
+    bbox = args.get('bbox')
+    if bbox is not None:
+        try:
+            bbox = tuple(float(value) for value in bbox.split(','))
+        except ValueError:
+            bbox = ()
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError('bbox must be minLat,minLng,maxLat,maxLng')
+    return bbox
+
+@app.route('/api/user_clusters', methods=['GET'])
+def get_user_clusters():
+    """
+    Return users aggregated into clusters for a map at ?zoom=, optionally within ?bbox=.
+
+    Clusters are grid cells about CLUSTER_PIXELS wide at that zoom, each with
+    its users' count and centroid, so the payload grows with the viewport
+    rather than the fleet. occupancy holds the number of users per district.
+    """
+    zoom = request.args.get('zoom', type=int)
+    if zoom is None or not 0 <= zoom <= MAX_CLUSTER_ZOOM:
+        return jsonify({'error': f'zoom must be an integer between 0 and {MAX_CLUSTER_ZOOM}'}), 400
+    try:
+        bbox = parse_bbox(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    cell_degrees = cluster_cell_degrees(zoom)
+    seq = location_store.seq
+    clusters = location_store.clusters(bbox, cell_degrees)
+    return jsonify({
+        'seq': seq,
+        'zoom': zoom,
+        'cell_degrees': cell_degrees,
+        'count': sum(cluster['count'] for cluster in clusters),
+        'clusters': clusters,
+        'occupancy': location_store.district_counts()
+    })
+
+def cluster_cell_degrees(zoom):
+    """Cluster cell size for a zoom level, snapped to a power-of-two multiple of the store's index cells"""
+    # A 256 pixel tile spans 360 / 2**zoom degrees of longitude
+    target = 360 * CLUSTER_PIXELS / (256 * 2 ** zoom)
+    base = location_store.CELL_DEGREES
+    return base * 2.0 ** round(math.log2(target / base))
+
+def location_response(payload, columnar):
+    response = jsonify(payload)
+    if columnar:
+        response.mimetype = COLUMNAR
+    response.vary.add('Accept')
+    return response
+
+relay_lock = threading.Lock()
+relay_thread = None
+
+def relay_changes():
+    """Follow a shared store's change feed and re-publish it to this process's stream clients"""
+    seq = location_store.seq
+    transition_id = location_store.transition_id
+    while True:
+        try:
+            refresh_districts()
+            feed = location_store.changes_since(seq, MAX_LONG_POLL_SECONDS)
+            if feed['changed'] or feed['removed']:
+                broadcaster.publish('location', feed)
+            seq = feed['seq']
+            # Transitions are written with the changes that caused them
+            while True:
+                page = location_store.transitions_since(transition_id, limit=MAX_TRANSITIONS)
+                if page['transitions']:
+                    publish_transitions(page['transitions'])
+                transition_id = page['id']
+                if len(page['transitions']) < MAX_TRANSITIONS:
+                    break
+        except Exception as e:
+            log.exception(f"Error relaying location changes: {e}")
+            time.sleep(1)
+
+def start_relay():
+    global relay_thread
+    if relay_thread is not None:
+        return
+    with relay_lock:
+        if relay_thread is None:
+            relay_thread = threading.Thread(target=relay_changes, name='change-relay', daemon=True)
+            relay_thread.start()
+
+expiry_lock = threading.Lock()
+expiry_thread = None
+
+def expire_users():
+    """Sweep stale users out of the store every EXPIRY_INTERVAL seconds"""
+    while True:
+        time.sleep(EXPIRY_INTERVAL)
+        try:
+            expired = location_store.expire()
+            if expired:
+                log.info(f"Removed {expired} stale users", extra={'users': expired})
+        except Exception as e:
+            log.exception(f"Error expiring users: {e}")
+
+def start_expiry():
+    global expiry_thread
+    if expiry_thread is not None:
+        return
+    with expiry_lock:
+        if expiry_thread is None:
+            expiry_thread = threading.Thread(target=expire_users, name='user-expiry', daemon=True)
+            expiry_thread.start()
+
+@app.route('/api/stream', methods=['GET'])
+def stream():
+    """
+    Server-sent events for live updates.
+
+    'location' events carry the same payload as the change feed, 'transition'
+    events carry new district transitions as /api/transitions lists them,
+    'districts' events announce a new district map, and 'resync' tells a
+    client that it fell behind and missed events, so it should catch up via
+    the change feed.
+    """
+    subscriber = broadcaster.subscribe()
+    seq = location_store.seq
+    if location_store.shared:
+        start_relay()
+    
+    def generate():
+        try:
+            yield f"retry: 5000\nevent: hello\ndata: {json.dumps({'seq': seq})}\n\n"
+            while True:
+                events, dropped = subscriber.get(STREAM_KEEPALIVE_SECONDS)
+                if dropped:
+                    yield f"event: resync\ndata: {json.dumps({'dropped': dropped})}\n\n"
+                if events:
+                    yield ''.join(events)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/districts', methods=['GET'])
 def get_districts():
-    """Return districts data for mobile app"""
-    return jsonify(DISTRICTS)
+    """
+    Return districts data for mobile app, pre-serialized and validated by ETag.
+
+    Clients that send Accept: application/vnd.locationtracker.polyline+json get
+    each polygon as an encoded polyline instead of nested float pairs.
+    ?lod=N picks a simplified tier (0, the default, is the exact map); a tier
+    still being built after a map change is served as the exact map.
+    """
+    tiers = DISTRICTS_BODIES
+    lod = request.args.get('lod', 0, type=int)
+    if not 0 <= lod < len(tiers):
+        return jsonify({'error': f'lod must be between 0 and {len(tiers) - 1}'}), 400
+    prepared = tiers[lod] or tiers[0]
+    return prepared[request.accept_mimetypes.best_match([JSON, POLYLINE]) or JSON].response()
+
+@app.route('/api/districts/stats', methods=['GET'])
+def get_district_stats():
+    """
+    Return current users per district and entry/exit rollups by minute and hour.
+
+    Each rollup lists its buckets oldest first from start, width seconds
+    apart, as per-district entries, exits and occupancy (users at the
+    bucket's first transition, null for a bucket without any). ?district=
+    limits the response to one district.
+    """
+    district = request.args.get('district') or None
+    occupancy = location_store.district_counts()
+    if district is not None:
+        occupancy = {district: occupancy.get(district, 0)}
+    return jsonify({
+        'occupancy': occupancy,
+        'minute': district_stats.series('minute', district),
+        'hour': district_stats.series('hour', district)
+    })
 
 @app.route('/api/districts', methods=['POST'])
 def update_districts():
     """Update district polygon definitions and save to file"""
     try:
-        global DISTRICTS
         new_districts = request.get_json()
         
         # Validate the data structure
@@ -169,17 +767,17 @@ def update_districts():
                 if not isinstance(point, list) or len(point) != 2:
                     return jsonify({'error': f'Invalid point in district {name}'}), 400
         
-        DISTRICTS = new_districts
+        old_index = DISTRICT_INDEX
+        set_districts(new_districts)
         
         # Save to file
         if not save_districts(DISTRICTS):
             return jsonify({'error': 'Failed to save districts to file'}), 500
         
-        # Recalculate districts for all existing users
-        with data_lock:
-            for username, data in location_data.items():
-                lat, lng = data['latitude'], data['longitude']
-                data['district'] = get_district(lat, lng)
+        broadcaster.publish('districts', {'count': len(DISTRICTS)})
+        
+        # Recalculate districts for users affected by the change
+        reclassify_users(old_index, DISTRICT_INDEX)
         
         return jsonify({'status': 'success', 'message': f'Saved {len(DISTRICTS)} districts to file'})
     
@@ -190,18 +788,17 @@ def update_districts():
 def reset_districts():
     """Reset districts to defaults"""
     try:
-        global DISTRICTS
-        DISTRICTS = DEFAULT_DISTRICTS.copy()
+        old_index = DISTRICT_INDEX
+        set_districts(DEFAULT_DISTRICTS.copy())
         
         # Save to file
         if not save_districts(DISTRICTS):
             return jsonify({'error': 'Failed to save districts to file'}), 500
         
-        # Recalculate districts for all existing users
-        with data_lock:
-            for username, data in location_data.items():
-                lat, lng = data['latitude'], data['longitude']
-                data['district'] = get_district(lat, lng)
+        broadcaster.publish('districts', {'count': len(DISTRICTS)})
+        
+        # Recalculate districts for users affected by the change
+        reclassify_users(old_index, DISTRICT_INDEX)
         
         return jsonify({'status': 'success', 'message': 'Reset to default districts'})
     
@@ -219,12 +816,18 @@ def debug_point():
         if lat is None or lng is None:
             return jsonify({'error': 'Missing lat or lng parameters'}), 400
         
+        index = DISTRICT_INDEX
+        compiled = dict(zip(index.names, index.compiled))
         results = {}
-        for district_name, polygon in DISTRICTS.items():
+        for district_name, polygon in index.districts.items():
             try:
+                # point_in_polygon is the reference implementation; report the
+                # compiled polygon's answer next to it so the two can be compared
                 is_inside = point_in_polygon(lat, lng, polygon)
                 results[district_name] = {
                     'inside': is_inside,
+                    'compiled_inside': compiled[district_name].contains(lat, lng)
+                                       if district_name in compiled else None,
                     'polygon_points': len(polygon),
                     'first_point': polygon[0] if polygon else None,
                     'last_point': polygon[-1] if polygon else None
@@ -245,6 +848,23 @@ def debug_point():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/debug/index', methods=['GET'])
+def debug_index():
+    """Debug endpoint describing the district index and its memory use"""
+    index = DISTRICT_INDEX
+    return jsonify({
+        'districts': len(index),
+        'errors': index.errors,
+        'grid': {'rows': index.rows, 'cols': index.cols},
+        'coarse_polygons': sum(compiled.coarse is not None for compiled in index.compiled),
+        'raster': index.raster.stats() if index.raster is not None else None
+    })
+
 @app.route('/')
 def dashboard():
     return render_template_string('''
@@ -404,8 +1024,9 @@ def dashboard():
             Object.keys(districts).forEach(name => {
                 const div = document.createElement('div');
                 div.className = 'district-item' + (name === selectedDistrict ? ' selected' : '');
+                const users = occupancy[name] ? ` (${occupancy[name]})` : '';
                 div.innerHTML = `
-                    <span>${name}</span>
+                    <span>${name}${users}</span>
                     <div>
                         <button class="edit-btn" onclick="selectDistrictForEditingByName('${name}')">Edit</button>
                         <button class="delete-btn" onclick="deleteDistrict('${name}')">Delete</button>
@@ -756,37 +1377,166 @@ def dashboard():
             }
         }
         
-        function updateUserLocations() {
-            fetch('/api/user_districts')
+        let userRows = {};
+        let userSeq = 0;
+        
+        // Past this many users in view, draw server-side clusters instead of markers
+        const MAX_MARKERS = 500;
+        const clusterLayer = L.layerGroup().addTo(map);
+        let clustered = false;
+        let clusterRefresh = null;
+        let occupancy = {};
+        
+        function renderUser(username, info) {
+            // Update the table row and marker in place rather than rebuilding them
+            let row = userRows[username];
+            if (!row) {
+                row = document.getElementById('locationData').insertRow();
+                for (let i = 0; i < 4; i++) row.insertCell(i);
+                userRows[username] = row;
+            }
+            row.cells[0].textContent = username;
+            row.cells[1].textContent = info.district;
+            row.cells[2].textContent = `${info.latitude.toFixed(6)}, ${info.longitude.toFixed(6)}`;
+            row.cells[3].textContent = new Date(info.timestamp).toLocaleTimeString();
+            
+            const popup = `${username}<br/>District: ${info.district}`;
+            if (userMarkers[username]) {
+                userMarkers[username].setLatLng([info.latitude, info.longitude]).setPopupContent(popup);
+            } else {
+                userMarkers[username] = L.marker([info.latitude, info.longitude])
+                    .bindPopup(popup)
+                    .addTo(map);
+            }
+        }
+        
+        function removeUser(username) {
+            if (userRows[username]) {
+                userRows[username].remove();
+                delete userRows[username];
+            }
+            if (userMarkers[username]) {
+                map.removeLayer(userMarkers[username]);
+                delete userMarkers[username];
+            }
+        }
+        
+        function applyUserChanges(data) {
+            // Changes carry each user's current state, so applying them in
+            // whatever order the feed and the stream deliver them is safe
+            if (data.full) {
+                Object.keys(userRows).forEach(removeUser);
+            }
+            Object.entries(data.changed).forEach(([username, info]) => renderUser(username, info));
+            data.removed.forEach(removeUser);
+            userSeq = Math.max(userSeq, data.seq);
+        }
+        
+        function viewportBbox() {
+            const bounds = map.getBounds();
+            return [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()]
+                .map(value => value.toFixed(6)).join(',');
+        }
+        
+        function updateUserLocations(wait = 0) {
+            // Only users inside the visible map are fetched and drawn
+            return fetch(`/api/user_districts?since=${userSeq}&wait=${wait}&bbox=${viewportBbox()}`)
                 .then(response => response.json())
                 .then(data => {
-                    const tbody = document.getElementById('locationData');
-                    tbody.innerHTML = '';
-                    
-                    // Clear existing user markers
-                    Object.values(userMarkers).forEach(marker => map.removeLayer(marker));
-                    userMarkers = {};
-                    
-                    Object.entries(data).forEach(([username, info]) => {
-                        // Add to table
-                        const row = tbody.insertRow();
-                        row.insertCell(0).textContent = username;
-                        row.insertCell(1).textContent = info.district;
-                        row.insertCell(2).textContent = `${info.latitude.toFixed(6)}, ${info.longitude.toFixed(6)}`;
-                        row.insertCell(3).textContent = new Date(info.timestamp).toLocaleTimeString();
-                        
-                        // Add marker to map
-                        const marker = L.marker([info.latitude, info.longitude])
-                            .bindPopup(`${username}<br/>District: ${info.district}`)
-                            .addTo(map);
-                        userMarkers[username] = marker;
-                    });
+                    if (!clustered) {
+                        applyUserChanges(data);
+                    } else if (data.seq !== userSeq) {
+                        userSeq = data.seq;
+                        return updateView();
+                    }
                 });
         }
         
-        // Update user locations every 10 seconds
-        setInterval(updateUserLocations, 10000);
-        updateUserLocations(); // Initial load
+        function updateView() {
+            // Clusters for the view decide whether individual markers are affordable
+            return fetch(`/api/user_clusters?zoom=${map.getZoom()}&bbox=${viewportBbox()}`)
+                .then(response => response.json())
+                .then(data => {
+                    occupancy = data.occupancy;
+                    updateDistrictsList();
+                    if (data.count > MAX_MARKERS) {
+                        clustered = true;
+                        Object.keys(userRows).forEach(removeUser);
+                        renderClusters(data.clusters);
+                        userSeq = Math.max(userSeq, data.seq);
+                    } else {
+                        clustered = false;
+                        clusterLayer.clearLayers();
+                        // A filtered feed from 0 replaces everything shown with the view's users
+                        userSeq = 0;
+                        return updateUserLocations();
+                    }
+                });
+        }
+        
+        function renderClusters(clusters) {
+            clusterLayer.clearLayers();
+            clusters.forEach(cluster => {
+                L.circleMarker([cluster.latitude, cluster.longitude], {
+                    radius: 8 + 3 * Math.log2(cluster.count)
+                }).bindTooltip(String(cluster.count), {permanent: true, direction: 'center'})
+                    .addTo(clusterLayer);
+            });
+        }
+        
+        function scheduleClusterRefresh() {
+            // Redraw clusters at most every couple of seconds however busy the stream is
+            if (!clusterRefresh) {
+                clusterRefresh = setTimeout(() => {
+                    clusterRefresh = null;
+                    updateView();
+                }, 2000);
+            }
+        }
+        
+        function applyStreamChanges(data) {
+            // Stream events cover every user; drop the ones outside the view
+            const bounds = map.getBounds();
+            Object.entries(data.changed).forEach(([username, info]) => {
+                if (bounds.contains([info.latitude, info.longitude])) {
+                    renderUser(username, info);
+                } else {
+                    removeUser(username);
+                }
+            });
+            data.removed.forEach(removeUser);
+            userSeq = Math.max(userSeq, data.seq);
+            if (Object.keys(userMarkers).length > MAX_MARKERS) {
+                scheduleClusterRefresh();
+            }
+        }
+        
+        map.on('moveend', () => updateView());
+        
+        function pollUserLocations() {
+            // Long-poll the change feed: the server answers as soon as anything
+            // changes, so only changed users are sent and redrawn
+            updateUserLocations(25)
+                .then(() => pollUserLocations())
+                .catch(() => setTimeout(pollUserLocations, 10000));
+        }
+        
+        if (window.EventSource) {
+            // Updates are pushed by the server; catch up through the change feed
+            // on every (re)connect and whenever the stream reports dropped events
+            const stream = new EventSource('/api/stream');
+            stream.addEventListener('hello', () => updateView());
+            stream.addEventListener('location', e => {
+                if (clustered) {
+                    scheduleClusterRefresh();
+                } else {
+                    applyStreamChanges(JSON.parse(e.data));
+                }
+            });
+            stream.addEventListener('resync', () => updateView());
+        } else {
+            updateView().then(pollUserLocations); // Initial load
+        }
 
         // Add test user function
         async function addTestUser() {
@@ -822,7 +1572,7 @@ def dashboard():
 @app.route('/api/add_test_user', methods=['POST'])
 def add_test_user():
     data = request.json
-    username = data.get('username', f'testuser_{len(location_data) + 1}')
+    username = str(data.get('username', f'testuser_{len(location_store) + 1}'))
     
     # Predefined test locations in different districts
     test_locations = [
@@ -838,23 +1588,21 @@ def add_test_user():
     # Pick a random test location
     location = random.choice(test_locations)
     
-    with data_lock:
-        location_data[username] = {
-            'lat': location['lat'],
-            'lng': location['lng'],
-            'timestamp': datetime.now().isoformat(),
-            'district': get_district(location['lat'], location['lng'])
-        }
+    record = UserLocation(location['lat'], location['lng'], datetime.now().isoformat(),
+                          get_district(location['lat'], location['lng']))
+    seq = location_store.put(username, record)
+    publish_locations({username: record}, seq)
+    record_history([(username, record)])
     
     return jsonify({
         'status': 'success',
         'username': username,
-        'location': location_data[username]
+        'location': record.to_dict()
     })
 
 if __name__ == '__main__':
-    print("Starting Location Tracker Server with Polygon Districts...")
-    print("Dashboard available at: http://localhost:5001")
-    print("Location API endpoint: http://localhost:5001/api/location")
-    print(f"Districts will be saved to: {DISTRICTS_FILE}")
+    log.info("Starting Location Tracker Server with Polygon Districts...")
+    log.info("Dashboard available at: http://localhost:5001")
+    log.info("Location API endpoint: http://localhost:5001/api/location")
+    log.info(f"Districts will be saved to: {DISTRICTS_FILE}")
     app.run(host='0.0.0.0', port=5001, debug=True) 
\ No newline at end of file
@@ -0,0 +1,319 @@
+"""
+Asyncio serving mode for the location tracker.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Serves the same API as app.py (and shares its state), but from an event loop,
+so idle connections cost a coroutine rather than a worker thread. The routes
+that hold connections or see the most traffic are native here:
+
+- POST /api/location        classification and storage run on a thread pool
+- GET  /api/user_districts  ?wait= long-polls sleep on the loop; bodies are built on a thread pool
+- GET  /api/districts       prepared bodies, served straight from memory
+- GET  /api/stream          server-sent events, one small queue per client
+
+Every other route is the Flask app itself, run on a pool of WSGI_THREADS
+threads. Needs the starlette, uvicorn and a2wsgi packages.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+
+import app as tracker
+from wire import COLUMNAR, JSON, POLYLINE, columnar_locations
+
+# Threads running the Flask app for the routes that aren't native here
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 32))
+# Users per json.dumps call when serializing locations. The C encoder holds the GIL for a
+# whole call, so a large body is encoded in slices to let the event loop run in between
+DUMPS_SLICE = 2000
+
+
+class LoopRelay:
+    """
+    Hands the process Broadcaster's events to coroutines on one event loop.
+
+    Subscribed to the Broadcaster only while stream clients or long-polls are
+    waiting, so publishing stays free when nobody is listening.
+    """
+
+    def __init__(self, broadcaster, queue_size):
+        self.broadcaster = broadcaster
+        self.queue_size = queue_size
+        self.loop = None
+        self.clients = set()
+        self.waiters = set()
+        self.subscribed = False
+
+    def put(self, payload):
+        # Called from whichever thread published the event
+        self.loop.call_soon_threadsafe(self._deliver, payload)
+
+    def _deliver(self, payload):
+        for client in self.clients:
+            client.put(payload)
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    def _update_subscription(self):
+        wanted = bool(self.clients or self.waiters)
+        if wanted and not self.subscribed:
+            self.loop = asyncio.get_running_loop()
+            if tracker.location_store.shared:
+                # Other processes' writes reach this one through the relay thread
+                tracker.start_relay()
+            self.broadcaster.subscribe(self)
+        elif not wanted and self.subscribed:
+            self.broadcaster.unsubscribe(self)
+        self.subscribed = wanted
+
+    def waiter(self):
+        """A future resolved by the next event; subscribe before checking state, then await it"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.add(waiter)
+        self._update_subscription()
+        return waiter
+
+    def forget(self, waiter):
+        self.waiters.discard(waiter)
+        self._update_subscription()
+
+    def subscribe(self):
+        client = StreamClient(self.queue_size)
+        self.clients.add(client)
+        self._update_subscription()
+        return client
+
+    def unsubscribe(self, client):
+        self.clients.discard(client)
+        self._update_subscription()
+
+
+class StreamClient:
+    """The asyncio counterpart of broadcast.Subscriber; only touched from the loop thread"""
+
+    def __init__(self, queue_size):
+        self.events = deque(maxlen=queue_size)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, payload):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(payload)
+        self.ready.set()
+
+    async def get(self, timeout):
+        if not self.events:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.ready.clear()
+        events = list(self.events)
+        self.events.clear()
+        dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+
+relay = LoopRelay(tracker.broadcaster, tracker.broadcaster.queue_size)
+
+
+async def store_call(function, *args):
+    """
+    Run a cheap location store call (like reading seq) inline for the
+    in-memory store, or on the thread pool for SQLite. Anything that scales
+    with the number of users goes to the thread pool for either store.
+    """
+    if tracker.location_store.shared:
+        return await run_in_threadpool(function, *args)
+    return function(*args)
+
+
+def json_response(payload, status=200, media_type=JSON, headers=None):
+    return Response(json.dumps(payload), status_code=status, media_type=media_type, headers=headers)
+
+
+def timed(route):
+    """Record a native route in the same request metrics the Flask hooks keep"""
+    def decorate(handler):
+        async def wrapper(request):
+            started = time.perf_counter()
+            response = await handler(request)
+            tracker.REQUEST_SECONDS.labels(route, request.method).observe(time.perf_counter() - started)
+            tracker.REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+            return response
+        return wrapper
+    return decorate
+
+
+@timed('/api/location')
+async def receive_location(request):
+    try:
+        data = await request.json()
+    except ValueError as e:
+        return json_response({'error': f'Invalid JSON body: {e}'}, 400)
+    if not isinstance(data, dict):
+        return json_response({'error': 'Expected a JSON object'}, 400)
+    latitude, longitude = data.get('latitude'), data.get('longitude')
+    if latitude is None or longitude is None:
+        return json_response({'error': 'Missing latitude or longitude'}, 400)
+    if not (tracker.valid_coordinate(latitude) and tracker.valid_coordinate(longitude)):
+        return json_response({'error': 'Latitude and longitude must be finite numbers'}, 400)
+    try:
+        district = await run_in_threadpool(tracker.store_location, data.get('username', 'unknown'),
+                                           latitude, longitude,
+                                           data.get('timestamp', datetime.now().isoformat()))
+    except Exception as e:
+        tracker.log.exception(f"Error processing location: {e}")
+        return json_response({'error': str(e)}, 500)
+    return json_response({'status': 'success', 'district': district})
+
+
+@timed('/api/user_districts')
+async def get_user_districts(request):
+    """Same contract as the Flask route; ?wait= waits on the event loop instead of a thread"""
+    accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+    columnar = accept.best_match([JSON, COLUMNAR]) == COLUMNAR
+    try:
+        bbox, district = tracker.parse_user_filters(request.query_params)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    try:
+        since = int(request.query_params['since'])
+    except (KeyError, ValueError):
+        since = None
+    if since is None:
+        body = await run_in_threadpool(snapshot_body, bbox, district, columnar)
+        return location_response(body, columnar)
+
+    wait = tracker.long_poll_wait(request.query_params.get('wait'))
+    deadline = time.monotonic() + wait
+    while True:
+        waiter = relay.waiter()
+        try:
+            if await store_call(lambda: tracker.location_store.seq) != since:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.wait([waiter], timeout=remaining)
+        finally:
+            relay.forget(waiter)
+    body = await run_in_threadpool(feed_body, since, bbox, district, columnar)
+    return location_response(body, columnar)
+
+
+def snapshot_body(bbox, district, columnar):
+    """Read and serialize a snapshot; runs on the thread pool so a large one can't stall the loop"""
+    snapshot = tracker.location_store.snapshot(bbox, district)
+    return json.dumps(columnar_locations(snapshot)) if columnar else dumps_users(snapshot)
+
+
+def feed_body(since, bbox, district, columnar):
+    """Read and serialize the change feed, like snapshot_body"""
+    feed = tracker.location_store.changes_since(since, 0, bbox, district)
+    if columnar:
+        feed['changed'] = columnar_locations(feed['changed'])
+        return json.dumps(feed)
+    changed = dumps_users(feed.pop('changed'))
+    return f'{json.dumps(feed)[:-1]}, "changed": {changed}}}'
+
+
+def dumps_users(users):
+    """json.dumps of a {username: location} map, DUMPS_SLICE users at a time"""
+    items = list(users.items())
+    slices = (json.dumps(dict(items[start:start + DUMPS_SLICE]))[1:-1]
+              for start in range(0, len(items), DUMPS_SLICE))
+    return '{' + ', '.join(slices) + '}'
+
+
+def location_response(body, columnar):
+    return Response(body, media_type=COLUMNAR if columnar else JSON, headers={'Vary': 'Accept'})
+
+
+@timed('/api/districts')
+async def get_districts(request):
+    tiers = tracker.DISTRICTS_BODIES
+    try:
+        lod = int(request.query_params.get('lod', 0))
+    except ValueError:
+        lod = 0
+    if not 0 <= lod < len(tiers):
+        return json_response({'error': f'lod must be between 0 and {len(tiers) - 1}'}, 400)
+    accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+    prepared = (tiers[lod] or tiers[0])[accept.best_match([JSON, POLYLINE]) or JSON]
+    status, body, headers = prepared.select(parse_etags(request.headers.get('if-none-match')),
+                                            parse_accept_header(request.headers.get('accept-encoding')))
+    return Response(body, status_code=status, media_type=prepared.mimetype if status == 200 else None,
+                    headers=headers)
+
+
+@timed('/api/stream')
+async def stream(request):
+    """Server-sent events, as in the Flask route"""
+    client = relay.subscribe()
+    seq = await store_call(lambda: tracker.location_store.seq)
+
+    async def generate():
+        try:
+            yield f"retry: 5000\nevent: hello\ndata: {json.dumps({'seq': seq})}\n\n"
+            while True:
+                events, dropped = await client.get(tracker.STREAM_KEEPALIVE_SECONDS)
+                if dropped:
+                    yield f"event: resync\ndata: {json.dumps({'dropped': dropped})}\n\n"
+                if events:
+                    yield ''.join(events)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            relay.unsubscribe(client)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def watch_districts():
+    """Pick up districts.json changes from other processes, as the Flask before_request hook does"""
+    while True:
+        await asyncio.sleep(tracker.DISTRICTS_CHECK_INTERVAL)
+        try:
+            await run_in_threadpool(tracker.refresh_districts)
+        except Exception as e:
+            tracker.log.exception(f"Error refreshing districts: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    tracker.start_background_threads()
+    watcher = asyncio.create_task(watch_districts())
+    try:
+        yield
+    finally:
+        watcher.cancel()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/location', receive_location, methods=['POST']),
+        Route('/api/user_districts', get_user_districts, methods=['GET']),
+        Route('/api/districts', get_districts, methods=['GET']),
+        Route('/api/stream', stream, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(tracker.app, workers=WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,444 @@
+"""
+Benchmarks for the location pipeline.
+
+    python bench.py -o results.json                    # everything
+    python bench.py --suites micro,client --quick      # a fast subset
+    python bench.py --compare before.json after.json   # diff two runs
+
+Suites:
+  micro   point_in_polygon (the old linear scan), get_district and the
+          vectorized classify(), on maps generated from districts.json by
+          tiling it (more districts) and subdividing its edges (more vertices)
+  client  POST /api/location and GET /api/user_districts through Flask's
+          test client, at several user counts
+  server  the same requests against a local gunicorn, from concurrent
+          keep-alive connections
+
+Results are JSON, one entry per benchmark and parameter set, with the commit
+they were measured at. Inputs are seeded, so runs are comparable.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The app reads its configuration at import; keep benchmark runs quiet and
+# their history out of the server's own directory
+_scratch = tempfile.mkdtemp(prefix='location-bench-')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('HISTORY_DIR', os.path.join(_scratch, 'history'))
+
+sys.path.insert(0, HERE)
+from districts_file import DistrictsFile  # noqa: E402
+from geometry import point_in_polygon  # noqa: E402
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def result(name, params, ops, seconds, latencies=None, errors=0):
+    entry = {
+        'name': name,
+        'params': params,
+        'ops': ops,
+        'seconds': round(seconds, 6),
+        'ops_per_sec': round(ops / seconds, 1) if seconds > 0 else None,
+        'mean_us': round(seconds / ops * 1e6, 2) if ops else None,
+    }
+    if latencies is not None:
+        latencies = sorted(latencies)
+        entry['p50_ms'] = round(percentile(latencies, 0.50) * 1000, 3) if latencies else None
+        entry['p99_ms'] = round(percentile(latencies, 0.99) * 1000, 3) if latencies else None
+        entry['errors'] = errors
+    print(f"{name:<28} {json.dumps(params, sort_keys=True):<48} "
+          f"{entry['ops_per_sec'] or 0:>14,.1f} ops/s", file=sys.stderr)
+    return entry
+
+
+def load_base_districts():
+    districts = DistrictsFile(os.path.join(HERE, 'districts.json')).load()
+    if not districts:
+        import app
+        districts = app.DEFAULT_DISTRICTS
+    return districts
+
+
+def synthetic_districts(base, copies, subdivide, seed=0):
+    """
+    Tile base copies times (side by side, so copies never overlap) and split
+    every edge into subdivide pieces, nudging the new vertices by ~0.2 m so
+    they look hand-drawn rather than collinear.
+    """
+    rng = random.Random(seed)
+    lats = [point[0] for polygon in base.values() for point in polygon]
+    lngs = [point[1] for polygon in base.values() for point in polygon]
+    height, width = max(lats) - min(lats), max(lngs) - min(lngs)
+    per_row = max(1, int(round(copies ** 0.5)))
+
+    districts = {}
+    for copy in range(copies):
+        d_lat = (copy // per_row) * height * 1.05
+        d_lng = (copy % per_row) * width * 1.05
+        for name, polygon in base.items():
+            points = []
+            for i, (lat, lng) in enumerate(polygon):
+                next_lat, next_lng = polygon[(i + 1) % len(polygon)]
+                for step in range(subdivide):
+                    t = step / subdivide
+                    wobble = rng.uniform(-2e-6, 2e-6) if step else 0.0
+                    points.append([lat + (next_lat - lat) * t + d_lat + wobble,
+                                   lng + (next_lng - lng) * t + d_lng + wobble])
+            districts[name if copy == 0 else f'{name} #{copy}'] = points
+    return districts
+
+
+def random_points(districts, count, seed=1):
+    rng = np.random.default_rng(seed)
+    lats = [point[0] for polygon in districts.values() for point in polygon]
+    lngs = [point[1] for polygon in districts.values() for point in polygon]
+    return (rng.uniform(min(lats), max(lats), count), rng.uniform(min(lngs), max(lngs), count))
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return time.perf_counter() - start
+
+
+def bench_micro(args, base):
+    import app
+
+    results = []
+    for copies in args.copies:
+        for subdivide in args.subdivide:
+            districts = synthetic_districts(base, copies, subdivide)
+            params = {'districts': len(districts),
+                      'vertices': sum(len(polygon) for polygon in districts.values())}
+            lats, lngs = random_points(districts, args.points)
+            points = list(zip(lats.tolist(), lngs.tolist()))
+
+            # The old linear scan is slow on big maps; a slice of the points is enough
+            scan_points = points[:max(1, args.points // (10 * copies * subdivide))]
+            start = time.perf_counter()
+            for lat, lng in scan_points:
+                for polygon in districts.values():
+                    if point_in_polygon(lat, lng, polygon):
+                        break
+            results.append(result('point_in_polygon_scan', params, len(scan_points),
+                                  time.perf_counter() - start))
+
+            start = time.perf_counter()
+            app.set_districts(districts)
+            results.append(result('set_districts', params, 1, time.perf_counter() - start))
+
+            get_district = app.get_district
+            seconds = timed(lambda: [get_district(lat, lng) for lat, lng in points], 1)
+            results.append(result('get_district', params, len(points), seconds))
+
+            index = app.DISTRICT_INDEX
+            seconds = timed(lambda: index.classify(lats, lngs), 3)
+            results.append(result('classify', params, 3 * len(points), seconds))
+
+    app.set_districts(base)
+    return results
+
+
+def populate_store(store, users, districts, seed=2):
+    from store import UserLocation
+    lats, lngs = random_points(districts, users, seed)
+    now = datetime.now().isoformat()
+    store.put_many([(f'user{i}', UserLocation(lat, lng, now, 'Outside Districts'))
+                    for i, (lat, lng) in enumerate(zip(lats.tolist(), lngs.tolist()))])
+
+
+def bench_client(args, base):
+    import app
+    from store import make_location_store
+
+    app.set_districts(base)
+    client = app.app.test_client()
+    results = []
+    for users in args.users:
+        # A fresh store per size, built and hooked up the way app.py builds its own,
+        # so locks are timed and MAX_USERS/USER_TTL_SECONDS apply as in production
+        app.location_store = make_location_store(app.timed_lock)
+        app.location_store.on_transitions = app.store_transitions
+        app.location_store.on_removed = app.store_removals
+        populate_store(app.location_store, users, base)
+        params = {'users': users}
+        lats, lngs = random_points(base, args.requests, seed=3)
+        rng = random.Random(4)
+        bodies = [{'username': f'user{rng.randrange(users)}', 'latitude': lat, 'longitude': lng}
+                  for lat, lng in zip(lats.tolist(), lngs.tolist())]
+
+        latencies, errors = [], 0
+        start = time.perf_counter()
+        for body in bodies:
+            t = time.perf_counter()
+            response = client.post('/api/location', json=body)
+            latencies.append(time.perf_counter() - t)
+            errors += response.status_code != 200
+        results.append(result('client_post_location', params, len(bodies),
+                              time.perf_counter() - start, latencies, errors))
+
+        # Full snapshots scale with the user count, so take fewer of them
+        snapshots = max(5, args.requests * 100 // users)
+        results.append(_client_gets(client, '/api/user_districts', snapshots,
+                                    'client_get_user_districts', params))
+        since = max(0, app.location_store.seq - 10)
+        results.append(_client_gets(client, f'/api/user_districts?since={since}', args.requests,
+                                    'client_get_user_districts_since', params))
+    return results
+
+
+def _client_gets(client, path, count, name, params):
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        latencies.append(time.perf_counter() - t)
+        errors += response.status_code != 200
+    return result(name, params, count, time.perf_counter() - start, latencies, errors)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workers, threads, scratch):
+    port = _free_port()
+    env = dict(os.environ, HISTORY_DIR=os.path.join(scratch, 'history'), LOG_LEVEL='WARNING')
+    env.pop('LOCATION_DB', None)
+    if workers > 1:
+        # Workers only agree on user state through the shared store
+        env['LOCATION_DB'] = os.path.join(scratch, 'locations.db')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '-b', f'127.0.0.1:{port}',
+         '--workers', str(workers), '--worker-class', 'gthread', '--threads', str(threads)],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process, port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def drive(port, requests, concurrency):
+    """Send (method, path, body) requests from concurrency keep-alive connections"""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    queue = list(reversed(requests))
+
+    def worker():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        while True:
+            with lock:
+                if not queue:
+                    break
+                method, path, body = queue.pop()
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            t = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                failed = response.status != 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                failed = True
+            local.append(time.perf_counter() - t)
+            if failed:
+                with lock:
+                    errors[0] += 1
+        connection.close()
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors[0]
+
+
+def bench_server(args, base):
+    if shutil.which('gunicorn') is None:
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            print('gunicorn is not installed; skipping the server suite', file=sys.stderr)
+            return []
+
+    results = []
+    for workers in args.workers:
+        for users in args.users:
+            scratch = tempfile.mkdtemp(dir=_scratch)
+            process, port = start_gunicorn(workers, args.threads, scratch)
+            try:
+                lats, lngs = random_points(base, users, seed=2)
+                fixes = [{'username': f'user{i}', 'latitude': lat, 'longitude': lng}
+                         for i, (lat, lng) in enumerate(zip(lats.tolist(), lngs.tolist()))]
+                for start in range(0, len(fixes), 1000):
+                    drive(port, [('POST', '/api/locations/batch',
+                                  json.dumps(fixes[start:start + 1000]))], 1)
+
+                params = {'users': users, 'workers': workers, 'threads': args.threads,
+                          'concurrency': args.concurrency}
+                lats, lngs = random_points(base, args.requests, seed=3)
+                rng = random.Random(4)
+                posts = [('POST', '/api/location', json.dumps(
+                             {'username': f'user{rng.randrange(users)}', 'latitude': lat, 'longitude': lng}))
+                         for lat, lng in zip(lats.tolist(), lngs.tolist())]
+                seconds, latencies, errors = drive(port, posts, args.concurrency)
+                results.append(result('server_post_location', params, len(posts), seconds, latencies, errors))
+
+                snapshots = max(10, args.requests * 100 // users)
+                gets = [('GET', '/api/user_districts', None)] * snapshots
+                seconds, latencies, errors = drive(port, gets, args.concurrency)
+                results.append(result('server_get_user_districts', params, len(gets), seconds,
+                                      latencies, errors))
+            finally:
+                process.terminate()
+                process.wait(10)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path, threshold):
+    """Print ops/sec and p99 changes between two result files; True if nothing regressed"""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    def keyed(run):
+        return {(entry['name'], json.dumps(entry['params'], sort_keys=True)): entry
+                for entry in run['results']}
+    old, new = keyed(before), keyed(after)
+
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}")
+    regressed = False
+    for key in sorted(old.keys() & new.keys()):
+        a, b = old[key], new[key]
+        if not a['ops_per_sec'] or not b['ops_per_sec']:
+            continue
+        change = b['ops_per_sec'] / a['ops_per_sec'] - 1
+        line = f"{key[0]:<28} {key[1]:<48} {a['ops_per_sec']:>12,.0f} -> {b['ops_per_sec']:>12,.0f} {change:+8.1%}"
+        if a.get('p99_ms') and b.get('p99_ms'):
+            line += f"   p99 {a['p99_ms']:.2f} -> {b['p99_ms']:.2f} ms"
+        if change < -threshold:
+            line += '   REGRESSION'
+            regressed = True
+        print(line)
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{key[0]:<28} {key[1]:<48} only in {'before' if key in old else 'after'}")
+    return not regressed
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the location pipeline.')
+    parser.add_argument('-o', '--output', help='write results JSON here (default: stdout)')
+    parser.add_argument('--suites', default='micro,client,server')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs, for a smoke run')
+    parser.add_argument('--copies', type=_int_list, help='map tilings for micro (default 1,4,16)')
+    parser.add_argument('--subdivide', type=_int_list, help='edge subdivisions for micro (default 1,4,16)')
+    parser.add_argument('--points', type=int, help='lookups per micro benchmark')
+    parser.add_argument('--users', type=_int_list, help='user counts (default 100,1000,10000)')
+    parser.add_argument('--requests', type=int, help='requests per HTTP benchmark')
+    parser.add_argument('--workers', type=_int_list, default=[1, 2], help='gunicorn worker counts')
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn threads per worker')
+    parser.add_argument('--concurrency', type=int, default=16, help='client connections for the server suite')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='ops/sec drop that counts as a regression in --compare')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 0 if compare(*args.compare, args.threshold) else 1
+
+    args.copies = args.copies or ([1, 4] if args.quick else [1, 4, 16])
+    args.subdivide = args.subdivide or ([1, 4] if args.quick else [1, 4, 16])
+    args.points = args.points or (2000 if args.quick else 20000)
+    args.users = args.users or ([100, 1000] if args.quick else [100, 1000, 10000])
+    args.requests = args.requests or (500 if args.quick else 5000)
+
+    base = load_base_districts()
+    suites = {'micro': bench_micro, 'client': bench_client, 'server': bench_server}
+    results = []
+    for name in args.suites.split(','):
+        if name not in suites:
+            parser.error(f'unknown suite {name!r}')
+        results.extend(suites[name](args, base))
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'time': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key != 'compare'},
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        status = main()
+    finally:
+        shutil.rmtree(_scratch, ignore_errors=True)
+    sys.exit(status)
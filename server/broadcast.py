@@ -0,0 +1,81 @@
+import json
+import threading
+from collections import deque
+
+
+class Subscriber:
+    """A bounded event queue for one stream client; the oldest events are dropped when full"""
+
+    def __init__(self, queue_size):
+        self.events = deque(maxlen=queue_size)
+        self.ready = threading.Condition()
+        self.dropped = 0
+
+    def put(self, payload):
+        with self.ready:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(payload)
+            self.ready.notify()
+
+    def get(self, timeout):
+        """
+        Wait up to timeout seconds and return (pending payloads, dropped count).
+
+        A non-zero dropped count means the client fell behind and missed events.
+        """
+        with self.ready:
+            if not self.events:
+                self.ready.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            dropped, self.dropped = self.dropped, 0
+            return events, dropped
+
+
+class Broadcaster:
+    """
+    Fan out server-sent events to every connected stream client.
+
+    Each event is serialized once and the same payload is appended to every
+    subscriber's queue, so the cost of an update does not depend on how much
+    state a client would otherwise have to re-fetch.
+    """
+
+    def __init__(self, queue_size=256):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, subscriber=None):
+        """
+        Add a subscriber and return it.
+
+        Anything with a put(payload) method may be passed in place of the
+        default queue, e.g. to hand events to another thread or event loop.
+        """
+        subscriber = subscriber or Subscriber(self.queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def publish(self, event, data):
+        if not self.subscribers:
+            return
+        payload = format_event(event, data)
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(payload)
+
+
+def format_event(event, data):
+    """Encode one event in text/event-stream framing"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,231 @@
+"""
+Assign districts to many points at once, in process or from the command line.
+
+    python classify.py points.csv -o classified.csv --workers 4
+
+Rows stream through in chunks, so files larger than memory work. The output
+is the input with a district column, named exactly as get_district would
+name it (first matching district in map order, "Outside Districts" when
+there is none or the coordinates don't parse).
+"""
+import argparse
+import csv
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from districts_file import DistrictsFile
+from geometry import DistrictIndex
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+OUTSIDE = "Outside Districts"
+CHUNK_SIZE = 100_000
+RASTER_BYTES = 1 << 20
+
+# Each pool worker builds its own index once, from the pickled district map
+_worker_index = None
+
+
+def _init_worker(districts, raster_bytes):
+    global _worker_index
+    _worker_index = DistrictIndex(districts, raster_bytes=raster_bytes)
+
+
+def _classify_in_worker(lats, lngs):
+    return _worker_index.classify(lats, lngs)
+
+
+def classify_chunks(chunks, districts, workers=1, raster_bytes=RASTER_BYTES):
+    """
+    Classify an iterable of (lats, lngs) array pairs, yielding district ids per chunk, in order.
+
+    districts is a {name: polygon} map or a DistrictIndex; ids index into
+    DistrictIndex(districts).names, with -1 for points outside every district.
+    With workers > 1, chunks are spread over a process pool, keeping only a
+    couple of chunks per worker in flight so memory stays bounded.
+    """
+    if isinstance(districts, DistrictIndex):
+        index, districts = districts, districts.districts
+    else:
+        index = None
+
+    if workers <= 1:
+        index = index or DistrictIndex(districts, raster_bytes=raster_bytes)
+        for lats, lngs in chunks:
+            yield index.classify(lats, lngs)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(districts, raster_bytes)) as pool:
+        pending = deque()
+        for lats, lngs in chunks:
+            pending.append(pool.submit(_classify_in_worker, np.asarray(lats, dtype=np.float64),
+                                       np.asarray(lngs, dtype=np.float64)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def classify_points(lats, lngs, districts, chunk_size=CHUNK_SIZE, workers=1,
+                    raster_bytes=RASTER_BYTES):
+    """
+    Return an int64 array of district ids for NumPy arrays of lats and lngs.
+
+    Same ids as DistrictIndex.classify (-1 outside), computed chunk_size points
+    at a time, optionally across a pool of worker processes.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    if lats.shape != lngs.shape:
+        raise ValueError('lats and lngs must have the same shape')
+    flat_lats, flat_lngs = lats.ravel(), lngs.ravel()
+    chunks = ((flat_lats[start:start + chunk_size], flat_lngs[start:start + chunk_size])
+              for start in range(0, len(flat_lats), chunk_size))
+    parts = list(classify_chunks(chunks, districts, workers, raster_bytes))
+    result = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+    return result.reshape(lats.shape)
+
+
+def _parse_coordinate(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # NaN never falls inside a district
+        return float('nan')
+
+
+def _file_index(districts, workers):
+    """The index whose names a file's ids refer to; it only needs a raster if it classifies too"""
+    return DistrictIndex(districts, raster_bytes=RASTER_BYTES if workers <= 1 else 0)
+
+
+def classify_csv(source, destination, districts, lat_column, lng_column,
+                 chunk_size=CHUNK_SIZE, workers=1):
+    """Copy a CSV file, adding a district column; returns the number of rows"""
+    index = _file_index(districts, workers)
+    names = index.names
+    with open(source, newline='') as infile, open(destination, 'w', newline='') as outfile:
+        reader = csv.DictReader(infile)
+        if lat_column not in (reader.fieldnames or ()) or lng_column not in reader.fieldnames:
+            raise ValueError(f'{source} has no {lat_column!r} and {lng_column!r} columns')
+        fieldnames = list(reader.fieldnames)
+        if 'district' not in fieldnames:
+            fieldnames.append('district')
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        writer.writeheader()
+
+        rows_in_flight = deque()
+
+        def chunks():
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) == chunk_size:
+                    yield _csv_chunk(rows, rows_in_flight, lat_column, lng_column)
+                    rows = []
+            if rows:
+                yield _csv_chunk(rows, rows_in_flight, lat_column, lng_column)
+
+        count = 0
+        for ids in classify_chunks(chunks(), index, workers):
+            rows = rows_in_flight.popleft()
+            for row, district_id in zip(rows, ids):
+                row['district'] = names[district_id] if district_id >= 0 else OUTSIDE
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def _csv_chunk(rows, rows_in_flight, lat_column, lng_column):
+    rows_in_flight.append(rows)
+    lats = np.fromiter((_parse_coordinate(row[lat_column]) for row in rows), np.float64, len(rows))
+    lngs = np.fromiter((_parse_coordinate(row[lng_column]) for row in rows), np.float64, len(rows))
+    return lats, lngs
+
+
+def classify_parquet(source, destination, districts, lat_column, lng_column,
+                     chunk_size=CHUNK_SIZE, workers=1):
+    """Copy a Parquet file, adding a district column; returns the number of rows"""
+    if pyarrow is None:
+        raise RuntimeError('Parquet files need the pyarrow package')
+    index = _file_index(districts, workers)
+    names = np.array(index.names + [OUTSIDE], dtype=object)
+    parquet = pyarrow.parquet.ParquetFile(source)
+    batches_in_flight = deque()
+
+    def chunks():
+        for batch in parquet.iter_batches(batch_size=chunk_size):
+            batches_in_flight.append(batch)
+            yield (_parquet_column(batch, lat_column), _parquet_column(batch, lng_column))
+
+    writer = None
+    count = 0
+    try:
+        for ids in classify_chunks(chunks(), index, workers):
+            batch = batches_in_flight.popleft()
+            # -1 picks the trailing OUTSIDE entry
+            column = pyarrow.array(names[ids], type=pyarrow.string())
+            if 'district' in batch.schema.names:
+                batch = batch.drop_columns(['district'])
+            table = pyarrow.Table.from_batches([batch]).append_column('district', column)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(destination, table.schema)
+            writer.write_table(table)
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def _parquet_column(batch, name):
+    column = batch.column(batch.schema.get_field_index(name))
+    try:
+        column = column.cast(pyarrow.float64())
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError):
+        return np.array([_parse_coordinate(value) for value in column.to_pylist()], dtype=np.float64)
+    return column.to_numpy(zero_copy_only=False).astype(np.float64)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Assign a district to every point in a CSV or Parquet file.')
+    parser.add_argument('input', help='CSV or .parquet file of points')
+    parser.add_argument('-o', '--output', help='output file (default: <input>.classified.<ext>)')
+    parser.add_argument('--districts', default=os.path.join(os.path.dirname(__file__), 'districts.json'),
+                        help='districts.json to classify against (default: the server\'s)')
+    parser.add_argument('--lat-column', default='latitude')
+    parser.add_argument('--lng-column', default='longitude')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes (0 = one per CPU)')
+    args = parser.parse_args(argv)
+
+    districts = DistrictsFile(args.districts).load()
+    if districts is None:
+        parser.error(f'no districts file at {args.districts}')
+
+    stem, ext = os.path.splitext(args.input)
+    output = args.output or f'{stem}.classified{ext}'
+    workers = args.workers or os.cpu_count() or 1
+    classify_file = classify_parquet if ext.lower() in ('.parquet', '.pq') else classify_csv
+    try:
+        count = classify_file(args.input, output, districts, args.lat_column, args.lng_column,
+                              args.chunk_size, workers)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f'classify: {e}', file=sys.stderr)
+        return 1
+    print(f'Classified {count} points against {len(districts)} districts into {output}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
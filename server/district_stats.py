@@ -0,0 +1,92 @@
+import threading
+import time
+
+
+class DistrictStats:
+    """
+    Per-district entry and exit counts, rolled up by minute and by hour.
+
+    Each granularity is a ring of buckets indexed by time, so recording a
+    transition touches one bucket and reading a window never scans history.
+    A bucket whose slot comes round again is reset on first use. When a bucket
+    opens, it also samples occupancy() ({district: users}) so readers can see
+    how many users each district held at the start of that minute or hour.
+    """
+
+    def __init__(self, occupancy, minutes=60, hours=24, clock=time.time):
+        self.occupancy = occupancy
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.rollups = {'minute': _Rollup(60, minutes), 'hour': _Rollup(3600, hours)}
+
+    def record(self, transitions):
+        """Count a batch of transitions ({'from', 'to', ...} dicts, None for no district)"""
+        now = self.clock()
+        with self.lock:
+            for rollup in self.rollups.values():
+                counts = rollup.bucket(now, self.occupancy)
+                for transition in transitions:
+                    if transition['from'] is not None:
+                        counts.setdefault(transition['from'], [0, 0])[1] += 1
+                    if transition['to'] is not None:
+                        counts.setdefault(transition['to'], [0, 0])[0] += 1
+
+    def series(self, granularity, district=None):
+        """
+        One granularity's buckets, oldest first, as parallel per-district lists.
+
+        Buckets without activity count zero entries and exits and have no
+        occupancy sample (None).
+        """
+        rollup = self.rollups[granularity]
+        now = self.clock()
+        with self.lock:
+            return rollup.series(now, district)
+
+
+class _Rollup:
+    __slots__ = ('width', 'size', 'starts', 'counts', 'samples')
+
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        # Per slot: bucket number, {district: [entries, exits]}, occupancy sample
+        self.starts = [None] * size
+        self.counts = [None] * size
+        self.samples = [None] * size
+
+    def bucket(self, now, occupancy):
+        number = int(now // self.width)
+        slot = number % self.size
+        if self.starts[slot] != number:
+            self.starts[slot] = number
+            self.counts[slot] = {}
+            self.samples[slot] = occupancy()
+        return self.counts[slot]
+
+    def series(self, now, district):
+        last = int(now // self.width)
+        first = last - self.size + 1
+        # The slot of each bucket in the window, or None where it holds an older bucket
+        slots = [n % self.size if self.starts[n % self.size] == n else None for n in range(first, last + 1)]
+        if district is not None:
+            names = [district]
+        else:
+            names = sorted({name for slot in slots if slot is not None
+                            for name in (*self.counts[slot], *self.samples[slot])})
+
+        districts = {}
+        for name in names:
+            entries, exits, occupancy = [], [], []
+            for slot in slots:
+                if slot is None:
+                    entries.append(0)
+                    exits.append(0)
+                    occupancy.append(None)
+                    continue
+                counts = self.counts[slot].get(name, (0, 0))
+                entries.append(counts[0])
+                exits.append(counts[1])
+                occupancy.append(self.samples[slot].get(name, 0))
+            districts[name] = {'entries': entries, 'exits': exits, 'occupancy': occupancy}
+        return {'start': first * self.width, 'width': self.width, 'districts': districts}
@@ -0,0 +1,171 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+FORMAT_VERSION = 1
+
+# version and generation are written first, so they sit in the file's header
+_GENERATION = re.compile(rb'"generation":\s*(\d+)')
+_HEADER_BYTES = 128
+
+log = logging.getLogger('location_tracker.districts_file')
+
+
+class DistrictsFile:
+    """
+    districts.json with crash-safe, non-blocking saves.
+
+    The file holds {"version", "generation", "districts"}. save() only queues
+    the map; a background thread writes the latest queued map to a temporary
+    file, fsyncs it and renames it over the original, so readers and crashes
+    only ever see a complete file. Saves queued while a write is in progress
+    (or within `delay` seconds of each other) collapse into one write.
+
+    Every write bumps the generation, under an flock so that it increases
+    across processes. Other workers notice a new generation by stat'ing the
+    file and reading its header, without parsing the whole map.
+    """
+
+    def __init__(self, path, delay=0.2, retry_delay=1.0, on_write=None):
+        self.path = path
+        self.delay = delay
+        self.retry_delay = retry_delay
+        # Called with (seconds, error or None) after every write attempt
+        self.on_write = on_write
+        # Generation of the map this process holds, and the file stamp it came with
+        self.generation = 0
+        self.stamp = None
+        self.error = None
+
+        self.pending = None
+        self.writing = False
+        self.ready = threading.Condition()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def stat(self):
+        """Cheap change detector: (mtime, size), or None if the file is missing"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def read_generation(self):
+        """Read just the generation from the file header (0 for legacy or missing files)"""
+        try:
+            with open(self.path, 'rb') as f:
+                match = _GENERATION.search(f.read(_HEADER_BYTES))
+        except OSError:
+            return 0
+        return int(match.group(1)) if match else 0
+
+    def load(self):
+        """Return the districts stored in the file, or None if there is no file"""
+        stamp = self.stat()
+        if stamp is None:
+            return None
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        if isinstance(data, dict) and isinstance(data.get('version'), int) \
+                and isinstance(data.get('districts'), dict):
+            districts, generation = data['districts'], data.get('generation', 0)
+        else:
+            # Files written before versioning are a bare {name: polygon} map
+            districts, generation = data, 0
+        self.generation, self.stamp = generation, stamp
+        return districts
+
+    def changed(self):
+        """True if another process saved a newer generation than the one we hold"""
+        stamp = self.stat()
+        if stamp is None or stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return self.read_generation() > self.generation
+
+    def save(self, districts):
+        """Queue districts to be written; returns immediately"""
+        with self.ready:
+            self.pending = districts
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='districts-writer', daemon=True)
+                self.thread.start()
+            self.ready.notify_all()
+
+    def flush(self, timeout=10):
+        """Wait until every queued save has been written. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.ready:
+            while self.pending is not None or self.writing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.ready.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self.ready:
+                while self.pending is None:
+                    self.ready.wait()
+            # Let a burst of saves settle so only the last one is written
+            time.sleep(self.delay)
+            with self.ready:
+                districts, self.pending = self.pending, None
+                self.writing = True
+            started = time.perf_counter()
+            try:
+                self._write(districts)
+                self.error = None
+                log.info(f"Saved {len(districts)} districts",
+                         extra={'path': self.path, 'generation': self.generation})
+            except Exception as e:
+                log.error(f"Error saving districts file: {e}", extra={'path': self.path})
+                self.error = e
+                with self.ready:
+                    # Retry unless a newer map was queued meanwhile
+                    if self.pending is None:
+                        self.pending = districts
+                time.sleep(self.retry_delay)
+            finally:
+                if self.on_write is not None:
+                    self.on_write(time.perf_counter() - started, self.error)
+                with self.ready:
+                    self.writing = False
+                    self.ready.notify_all()
+
+    def _write(self, districts):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            generation = max(self.generation, self.read_generation()) + 1
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.districts-', suffix='.tmp')
+            try:
+                # mkstemp creates the file owner-only; keep the usual permissions
+                os.fchmod(fd, 0o644)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'version': FORMAT_VERSION, 'generation': generation,
+                               'districts': districts}, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # Claim the generation before the rename so our own change check skips it
+                self.generation = generation
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            # Make the rename itself durable
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self.stamp = self.stat()
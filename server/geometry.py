@@ -0,0 +1,797 @@
+import math
+from array import array
+
+import numpy as np
+
+METERS_PER_DEGREE = 111_320
+
+
+def point_in_polygon(lat, lng, polygon):
+    """
+    Improved ray casting algorithm to determine if a point is inside a polygon.
+    polygon: list of [lat, lng] coordinates
+    """
+    if len(polygon) < 3:
+        return False
+
+    x, y = lng, lat
+    n = len(polygon)
+    inside = False
+
+    # Use the standard ray casting algorithm
+    j = n - 1
+    for i in range(n):
+        xi, yi = polygon[i][1], polygon[i][0]  # lng, lat
+        xj, yj = polygon[j][1], polygon[j][0]  # lng, lat
+
+        if ((yi > y) != (yj > y)) and (x < (xj - xi) * (y - yi) / (yj - yi) + xi):
+            inside = not inside
+        j = i
+
+    return inside
+
+
+class CompiledPolygon:
+    """
+    A district polygon compiled for repeated containment tests.
+
+    Vertices are kept in contiguous arrays, and every non-horizontal edge is
+    reduced to its lat range, an anchor point and a precomputed slope
+    (lng change per unit of lat). contains() then runs the same ray cast as
+    point_in_polygon without indexing nested lists or dividing per edge.
+    Horizontal edges can never be crossed by the ray and are dropped.
+    """
+
+    __slots__ = ('lats', 'lngs', 'bbox', 'edge_lo', 'edge_hi',
+                 'edge_lat', 'edge_lng', 'edge_slope', 'coarse', 'band')
+
+    # A coarse ring only pays off when it drops most of the edges
+    MAX_COARSE_EDGE_RATIO = 0.5
+
+    def __init__(self, polygon, coarse_tolerance=0.0):
+        self.lats = array('d', (float(point[0]) for point in polygon))
+        self.lngs = array('d', (float(point[1]) for point in polygon))
+        if any(len(point) != 2 for point in polygon):
+            raise ValueError('polygon points must be [lat, lng] pairs')
+        self.bbox = (min(self.lats), min(self.lngs), max(self.lats), max(self.lngs))
+
+        self.edge_lo = array('d')
+        self.edge_hi = array('d')
+        self.edge_lat = array('d')
+        self.edge_lng = array('d')
+        self.edge_slope = array('d')
+        self.coarse = None
+        self.band = 0.0
+        if len(self.lats) < 3:
+            return
+
+        n = len(self.lats)
+        j = n - 1
+        for i in range(n):
+            yi, xi = self.lats[i], self.lngs[i]
+            yj, xj = self.lats[j], self.lngs[j]
+            if yi != yj:
+                self.edge_lo.append(min(yi, yj))
+                self.edge_hi.append(max(yi, yj))
+                # Anchoring at the edge's own vertex (rather than a lat=0
+                # intercept) keeps the comparison as precise as the reference
+                self.edge_lat.append(yi)
+                self.edge_lng.append(xi)
+                self.edge_slope.append((xj - xi) / (yj - yi))
+            j = i
+
+        if coarse_tolerance > 0:
+            simplified = simplify_ring(polygon, coarse_tolerance)
+            if len(simplified) <= len(polygon) * self.MAX_COARSE_EDGE_RATIO:
+                # Widen the band a little so rounding never lets a point slip through
+                self.band = coarse_tolerance * (1 + 1e-6)
+                self.coarse = _CoarseRing(simplified, self.band)
+
+    def contains(self, lat, lng):
+        """Ray-cast containment test, equivalent to point_in_polygon"""
+        min_lat, min_lng, max_lat, max_lng = self.bbox
+        if lat < min_lat or lat > max_lat or lng < min_lng or lng > max_lng:
+            return False
+        if self.coarse is not None:
+            inside = self.coarse.contains(lat, lng)
+            if inside is not None:
+                return inside
+        inside = False
+        for lo, hi, y0, x0, slope in zip(self.edge_lo, self.edge_hi, self.edge_lat,
+                                         self.edge_lng, self.edge_slope):
+            # (yi > y) != (yj > y) is exactly lo <= y < hi for a non-horizontal edge
+            if lo <= lat < hi and lng < x0 + slope * (lat - y0):
+                inside = not inside
+        return inside
+
+
+
+class _CoarseRing:
+    """
+    A simplified ring that answers containment only away from its own edges.
+
+    Douglas-Peucker keeps the simplified ring within the tolerance of the
+    original, so a point farther than that from every simplified edge is on
+    the same side of both. contains() returns None inside that band, where
+    only the exact polygon can decide.
+    """
+
+    __slots__ = ('band_sq', 'edges')
+
+    def __init__(self, ring, band):
+        self.band_sq = band * band
+        self.edges = []
+        for i in range(len(ring)):
+            ay, ax = float(ring[i - 1][0]), float(ring[i - 1][1])
+            by, bx = float(ring[i][0]), float(ring[i][1])
+            dy, dx = by - ay, bx - ax
+            length_sq = dy * dy + dx * dx
+            self.edges.append((
+                # Box around the edge, grown by the band, for a cheap reject
+                min(ay, by) - band, max(ay, by) + band, min(ax, bx) - band, max(ax, bx) + band,
+                ay, ax, dy, dx, 1 / length_sq if length_sq else 0.0,
+                # Ray-cast terms; horizontal edges get an empty lat range
+                min(ay, by), max(ay, by) if dy else min(ay, by), dx / dy if dy else 0.0,
+            ))
+
+    def contains(self, lat, lng):
+        """True/False away from the edges, None within the band"""
+        inside = False
+        for y_min, y_max, x_min, x_max, ay, ax, dy, dx, inverse, lo, hi, slope in self.edges:
+            if y_min <= lat <= y_max and x_min <= lng <= x_max:
+                t = min(1.0, max(0.0, ((lat - ay) * dy + (lng - ax) * dx) * inverse))
+                ey, ex = lat - ay - t * dy, lng - ax - t * dx
+                if ey * ey + ex * ex <= self.band_sq:
+                    return None
+            if lo <= lat < hi and lng < ax + slope * (lat - ay):
+                inside = not inside
+        return inside
+
+
+def _rings_near(first, second, margin):
+    """True if any vertex of either ring is within margin of the other ring"""
+    region = _pair_region(first.bbox, second.bbox, margin)
+    for compiled, other in ((first, second), (second, first)):
+        edges = _SegmentGrid(region, margin, _edges(_ring(other)))
+        if any(_near_segments(lat, lng, edges, margin) for lat, lng in zip(compiled.lats, compiled.lngs)):
+            return True
+    return False
+
+
+def _areas_overlap(first, second, margin):
+    """
+    Conservative test for two polygons sharing area.
+
+    True when their edges properly cross, when a vertex or edge midpoint of
+    one lies inside the other clear of its boundary, or when one ring lies
+    entirely on the other's boundary (coincident districts). Polygons that
+    merely share a border are not overlapping.
+    """
+    a, b = _ring(first), _ring(second)
+    # Everything that can cross, touch or be shared lies where the bboxes meet
+    region = _pair_region(first.bbox, second.bbox, margin)
+    a_edges, b_edges = _SegmentGrid(region, margin, _edges(a)), _SegmentGrid(region, margin, _edges(b))
+    if any(_crosses(p, q, r, t) for p, q in _edges(a) for r, t in b_edges.near(_bbox((p, q)))):
+        return True
+    boundary = margin * 1e-3
+    for ring, other, compiled in ((a, b_edges, second), (b, a_edges, first)):
+        min_lat, min_lng, max_lat, max_lng = compiled.bbox
+        samples = ring + [((p[0] + q[0]) / 2, (p[1] + q[1]) / 2) for p, q in _edges(ring)]
+        on_boundary = 0
+        for lat, lng in samples:
+            # Outside the other's bbox a sample is neither inside nor on its boundary
+            if not (min_lat - boundary <= lat <= max_lat + boundary and min_lng - boundary <= lng <= max_lng + boundary):
+                continue
+            if _near_segments(lat, lng, other, boundary):
+                on_boundary += 1
+            elif compiled.contains(lat, lng):
+                return True
+        if on_boundary == len(samples):
+            return True
+    return False
+
+
+def _pair_region(a, b, margin):
+    """Where two bboxes overlap, grown by margin; anything of one within margin of the other lies inside"""
+    return (max(a[0], b[0]) - margin, max(a[1], b[1]) - margin,
+            min(a[2], b[2]) + margin, min(a[3], b[3]) + margin)
+
+
+def _near_segments(lat, lng, grid, margin):
+    """True if the point is within margin of a segment in grid"""
+    margin_sq = margin * margin
+    return any(_segment_distance_sq(lat, lng, a[0], a[1], b[0], b[1]) <= margin_sq
+               for a, b in grid.near((lat - margin, lng - margin, lat + margin, lng + margin)))
+
+
+def _ring(compiled):
+    return list(zip(compiled.lats, compiled.lngs))
+
+
+def _segment_distance_sq(py, px, ay, ax, by, bx):
+    """Squared planar distance (in degrees) from point p to segment ab"""
+    dy, dx = by - ay, bx - ax
+    length_sq = dy * dy + dx * dx
+    if length_sq == 0:
+        t = 0.0
+    else:
+        t = min(1.0, max(0.0, ((py - ay) * dy + (px - ax) * dx) / length_sq))
+    ey, ex = py - (ay + t * dy), px - (ax + t * dx)
+    return ey * ey + ex * ex
+
+
+def simplify_ring(polygon, tolerance, pinned=()):
+    """
+    Douglas-Peucker simplification of a closed ring.
+
+    Returns a subset of polygon's points, in order, such that every dropped
+    vertex lies within tolerance (degrees) of the simplified ring. Vertices
+    whose indices are in pinned are always kept. Rings that would collapse
+    below a triangle are returned unchanged.
+    """
+    points = [(float(point[0]), float(point[1])) for point in polygon]
+    return [polygon[i] for i in _simplified_indices(points, tolerance, pinned)]
+
+
+def _simplified_indices(points, tolerance, pinned=()):
+    n = len(points)
+    if n <= 3 or tolerance <= 0:
+        return list(range(n))
+
+    # Split the ring at vertex 0 and the vertex farthest from it
+    y0, x0 = points[0]
+    far = max(range(n), key=lambda i: (points[i][0] - y0) ** 2 + (points[i][1] - x0) ** 2)
+    keep = sorted({0, far, *pinned})
+    tolerance_sq = tolerance * tolerance
+
+    kept = set(keep)
+    stack = [(keep[k], keep[k + 1] if k + 1 < len(keep) else n) for k in range(len(keep))]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        ay, ax = points[start]
+        by, bx = points[end % n]
+        worst, worst_sq = None, tolerance_sq
+        for i in range(start + 1, end):
+            d = _segment_distance_sq(points[i][0], points[i][1], ay, ax, by, bx)
+            if d > worst_sq:
+                worst, worst_sq = i, d
+        if worst is not None:
+            kept.add(worst)
+            stack.append((start, worst))
+            stack.append((worst, end))
+
+    if len(kept) < 3:
+        return list(range(n))
+    return sorted(kept)
+
+
+def _crosses(a, b, c, d):
+    """True if segments ab and cd properly cross (touching endpoints doesn't count)"""
+    def orient(p, q, r):
+        value = (q[1] - p[1]) * (r[0] - p[0]) - (q[0] - p[0]) * (r[1] - p[1])
+        return (value > 0) - (value < 0)
+    o1, o2 = orient(a, b, c), orient(a, b, d)
+    o3, o4 = orient(c, d, a), orient(c, d, b)
+    return o1 * o2 < 0 and o3 * o4 < 0
+
+
+def _edges(ring):
+    return [(ring[i - 1], ring[i]) for i in range(len(ring))]
+
+
+def _bbox(points):
+    return (min(p[0] for p in points), min(p[1] for p in points),
+            max(p[0] for p in points), max(p[1] for p in points))
+
+
+class _SegmentGrid:
+    """
+    Segments ((lat, lng), (lat, lng) pairs) bucketed by the cells their
+    bounding boxes touch, so a query only sees segments near its box.
+
+    Only the part of each segment inside region is bucketed; queries must lie
+    inside region too. Points are stored as zero-length segments.
+    """
+
+    # A query spanning the whole region touches at most this many cells per axis
+    CELLS_PER_AXIS = 32
+
+    def __init__(self, region, minimum_cell, segments=()):
+        self.region = region
+        self.cell = max(region[2] - region[0], region[3] - region[1]) / self.CELLS_PER_AXIS
+        self.cell = max(self.cell, minimum_cell) or 1.0
+        self.buckets = {}
+        buckets = self.buckets
+        for segment in segments:
+            (ay, ax), (by, bx) = segment
+            lats = (ay, by) if ay <= by else (by, ay)
+            lngs = (ax, bx) if ax <= bx else (bx, ax)
+            for key in self._cells(lats[0], lngs[0], lats[1], lngs[1]):
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = [segment]
+                else:
+                    bucket.append(segment)
+
+    def _cells(self, min_lat, min_lng, max_lat, max_lng):
+        region, cell = self.region, self.cell
+        if min_lat < region[0]:
+            min_lat = region[0]
+        if min_lng < region[1]:
+            min_lng = region[1]
+        if max_lat > region[2]:
+            max_lat = region[2]
+        if max_lng > region[3]:
+            max_lng = region[3]
+        if min_lat > max_lat or min_lng > max_lng:
+            return ()
+        row_lo, row_hi = math.floor(min_lat / cell), math.floor(max_lat / cell)
+        col_lo, col_hi = math.floor(min_lng / cell), math.floor(max_lng / cell)
+        if row_lo == row_hi and col_lo == col_hi:
+            return ((row_lo, col_lo),)
+        return [(row, col) for row in range(row_lo, row_hi + 1) for col in range(col_lo, col_hi + 1)]
+
+    def near(self, bbox):
+        """Each segment bucketed in a cell bbox touches, once"""
+        found = {}
+        for key in self._cells(*bbox):
+            for segment in self.buckets.get(key, ()):
+                found[segment] = None
+        return found
+
+
+def simplify_districts(districts, tolerance):
+    """
+    Simplify every district to within tolerance without changing the map's topology.
+
+    Vertices within tolerance of another district's boundary are pinned, so
+    shared and neighbouring borders stay exactly as drawn and no gaps or
+    overlaps open up between districts. Each simplified ring is then checked
+    for new crossings with itself and with its neighbours' final rings; a
+    district that fails at every tolerance down to a quarter of the requested
+    one keeps its original polygon. Malformed polygons are passed through.
+    Every check only looks at the other boundaries near it, through a
+    _SegmentGrid over the district's bounding box.
+    """
+    rings = {}
+    for name, polygon in districts.items():
+        try:
+            rings[name] = [(float(point[0]), float(point[1])) for point in polygon]
+            if any(len(point) != 2 for point in polygon):
+                raise ValueError
+        except (TypeError, ValueError, IndexError):
+            continue
+    bboxes = {name: _bbox(ring) for name, ring in rings.items() if ring}
+
+    def neighbours(name, margin):
+        a = bboxes[name]
+        return [other for other, b in bboxes.items() if other != name and
+                a[0] - margin <= b[2] and b[0] - margin <= a[2] and
+                a[1] - margin <= b[3] and b[1] - margin <= a[3]]
+
+    # Start from the originals; each district is replaced as it is simplified
+    final = dict(rings)
+    simplified = {}
+    for name, polygon in districts.items():
+        ring = rings.get(name)
+        if not ring or len(ring) <= 3:
+            simplified[name] = polygon
+            continue
+        n = len(ring)
+        near = neighbours(name, tolerance)
+        box = bboxes[name]
+        region = (box[0] - tolerance, box[1] - tolerance, box[2] + tolerance, box[3] + tolerance)
+
+        borders = _SegmentGrid(region, tolerance, [edge for other in near for edge in _edges(rings[other])])
+        pinned = [i for i, (lat, lng) in enumerate(ring) if _near_segments(lat, lng, borders, tolerance)]
+        others = [edge for other in near for edge in _edges(final[other])]
+        # Also catch a small neighbour swallowed whole by a shortcut, which crosses nothing
+        probes = _SegmentGrid(region, tolerance, [(point, point) for other in near for point in final[other]])
+        sides = {}
+
+        result = polygon
+        for attempt in (tolerance, tolerance / 2, tolerance / 4):
+            indices = _simplified_indices(ring, attempt, pinned)
+            if len(indices) == n:
+                break
+            candidate = [ring[i] for i in indices]
+            edges = _edges(candidate)
+            # Only edges that skip a vertex are new
+            new = [k for k in range(len(indices)) if (indices[k] - indices[k - 1]) % n != 1]
+            segments = _SegmentGrid(region, tolerance, edges + others)
+            if any(_crosses(a, b, c, d) for a, b in (edges[k] for k in new)
+                   for c, d in segments.near(_bbox((a, b)))):
+                continue
+            # A probe can only change sides inside the area between a new edge and the vertices it skips
+            moved = {}
+            for k in new:
+                start, end = indices[k - 1], indices[k]
+                moved.update(probes.near(_bbox([ring[i % n] for i in range(start, end + (n if end < start else 0) + 1)])))
+            for point, _ in moved:
+                if point not in sides:
+                    sides[point] = point_in_polygon(point[0], point[1], ring)
+            if all(point_in_polygon(point[0], point[1], candidate) == sides[point] for point, _ in moved):
+                result = [polygon[i] for i in indices]
+                final[name] = candidate
+                break
+        simplified[name] = result
+    return simplified
+
+
+def changed_regions(old, new):
+    """
+    Return the bounding boxes where lookups can differ between two indexes.
+
+    Covers districts that were added, removed or reshaped, plus districts whose
+    relative order changed, since the first match in dict order wins where
+    polygons overlap. A point outside all returned boxes classifies the same
+    under both indexes.
+    """
+    old_bboxes = dict(zip(old.names, old.bboxes))
+    new_bboxes = dict(zip(new.names, new.bboxes))
+    changed = set(old_bboxes) ^ set(new_bboxes)
+
+    common = [name for name in old.names if name in new_bboxes]
+    for name in common:
+        if old.districts[name] != new.districts[name]:
+            changed.add(name)
+    new_order = [name for name in new.names if name in old_bboxes]
+    changed.update(a for a, b in zip(common, new_order) if a != b)
+
+    return ([old_bboxes[name] for name in changed if name in old_bboxes] +
+            [new_bboxes[name] for name in changed if name in new_bboxes])
+
+
+class DistrictIndex:
+    """
+    Immutable spatial index over a district map.
+
+    Every district's bounding box is bucketed into a uniform grid covering the
+    extent of the whole map, so a lookup only tests the polygons registered in
+    the point's cell. Candidates keep the original dict order, which preserves
+    the first-match semantics of a linear scan over DISTRICTS.
+
+    With a coarse_tolerance, lookups of detailed polygons first test a
+    simplified ring and fall back to the exact one only near its edges. With
+    raster_bytes, a DistrictRaster of that size answers most points before
+    any polygon is tested; one built later may be attached as .raster instead.
+
+    The index also records which districts border each other and which
+    earlier districts overlap each one, so locate() can start from a hint
+    (the user's last district) and still give the first-match answer.
+    """
+
+    # Aim for a few cells per district so most cells hold one or two candidates
+    CELLS_PER_DISTRICT = 4
+    MAX_CELLS_PER_AXIS = 256
+    # Districts whose boundaries come within this many degrees are neighbours
+    ADJACENCY_TOLERANCE = 1e-4
+
+    def __init__(self, districts, coarse_tolerance=0.0, raster_bytes=0):
+        self.districts = districts
+        self.names = []
+        self.polygons = []
+        self.compiled = []
+        self.bboxes = []
+        self.errors = {}
+
+        for name, polygon in districts.items():
+            try:
+                compiled = CompiledPolygon(polygon, coarse_tolerance)
+            except Exception as e:
+                # Malformed polygons never match, same as the old linear scan
+                self.errors[name] = str(e)
+                continue
+            self.names.append(name)
+            self.polygons.append(polygon)
+            self.compiled.append(compiled)
+            self.bboxes.append(compiled.bbox)
+
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        self._build_grid()
+        self._build_adjacency()
+        self.raster = DistrictRaster(self, raster_bytes) if raster_bytes > 0 and self.extent else None
+
+    def _build_grid(self):
+        if not self.bboxes:
+            self.extent = None
+            self.rows = self.cols = 0
+            self.cells = []
+            return
+
+        min_lat = min(b[0] for b in self.bboxes)
+        min_lng = min(b[1] for b in self.bboxes)
+        max_lat = max(b[2] for b in self.bboxes)
+        max_lng = max(b[3] for b in self.bboxes)
+        self.extent = (min_lat, min_lng, max_lat, max_lng)
+
+        per_axis = math.ceil(math.sqrt(len(self.bboxes) * self.CELLS_PER_DISTRICT))
+        per_axis = max(1, min(per_axis, self.MAX_CELLS_PER_AXIS))
+        self.rows = per_axis
+        self.cols = per_axis
+        # Guard against degenerate (zero-height or zero-width) extents
+        self.cell_height = (max_lat - min_lat) / self.rows or 1.0
+        self.cell_width = (max_lng - min_lng) / self.cols or 1.0
+
+        cells = [[] for _ in range(self.rows * self.cols)]
+        for i, (b_min_lat, b_min_lng, b_max_lat, b_max_lng) in enumerate(self.bboxes):
+            row_lo, col_lo = self._cell_of(b_min_lat, b_min_lng)
+            row_hi, col_hi = self._cell_of(b_max_lat, b_max_lng)
+            for row in range(row_lo, row_hi + 1):
+                for col in range(col_lo, col_hi + 1):
+                    cells[row * self.cols + col].append(i)
+        self.cells = [tuple(cell) for cell in cells]
+
+    def _build_adjacency(self):
+        """
+        Fill neighbours[i] (districts within ADJACENCY_TOLERANCE of i) and
+        shadowed_by[i] (earlier districts whose area overlaps i's, which win
+        any point the two share).
+        """
+        count = len(self.compiled)
+        self.neighbours = [[] for _ in range(count)]
+        self.shadowed_by = [[] for _ in range(count)]
+        margin = self.ADJACENCY_TOLERANCE
+        for i in range(count):
+            a = self.bboxes[i]
+            for j in range(i + 1, count):
+                b = self.bboxes[j]
+                if a[0] - margin > b[2] or b[0] - margin > a[2] or \
+                        a[1] - margin > b[3] or b[1] - margin > a[3]:
+                    continue
+                first, second = self.compiled[i], self.compiled[j]
+                if _rings_near(first, second, margin):
+                    self.neighbours[i].append(j)
+                    self.neighbours[j].append(i)
+                if _areas_overlap(first, second, margin):
+                    self.shadowed_by[j].append(i)
+        self.neighbours = [tuple(n) for n in self.neighbours]
+        self.shadowed_by = [tuple(s) for s in self.shadowed_by]
+
+    def _cell_of(self, lat, lng):
+        """Clamp a point inside the extent to its (row, col)"""
+        row = int((lat - self.extent[0]) / self.cell_height)
+        col = int((lng - self.extent[1]) / self.cell_width)
+        return min(max(row, 0), self.rows - 1), min(max(col, 0), self.cols - 1)
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, lat, lng):
+        """Return indices of districts whose bounding box contains the point, in order"""
+        if self.extent is None:
+            return ()
+        min_lat, min_lng, max_lat, max_lng = self.extent
+        if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+            return ()
+        row, col = self._cell_of(lat, lng)
+        bboxes = self.bboxes
+        return [i for i in self.cells[row * self.cols + col]
+                if bboxes[i][0] <= lat <= bboxes[i][2] and bboxes[i][1] <= lng <= bboxes[i][3]]
+
+    def trace(self, lat, lng):
+        """Return (name, inside) for every candidate district, for debugging"""
+        return [(self.names[i], self.compiled[i].contains(lat, lng))
+                for i in self.candidates(lat, lng)]
+
+    def lookup(self, lat, lng):
+        """Return the name of the first district containing the point, or None"""
+        name, _ = self.locate(lat, lng)
+        return name
+
+    def locate(self, lat, lng, hint=None):
+        """
+        Like lookup, but returns (name or None, number of polygons tested).
+
+        hint is a district index to try first, followed by its neighbours;
+        a district found that way is only returned if none of the earlier
+        districts overlapping it also contains the point.
+        """
+        if self.raster is not None:
+            hit = self.raster.lookup(lat, lng)
+            if hit != DistrictRaster.BOUNDARY:
+                return (self.names[hit] if hit >= 0 else None), 0
+        tested = 0
+        outside = ()
+        if hint is not None:
+            outside = set()
+            for i in (hint,) + self.neighbours[hint]:
+                b = self.bboxes[i]
+                if not (b[0] <= lat <= b[2] and b[1] <= lng <= b[3]):
+                    outside.add(i)
+                    continue
+                tested += 1
+                if not self.compiled[i].contains(lat, lng):
+                    outside.add(i)
+                    continue
+                shadows = [j for j in self.shadowed_by[i] if j not in outside]
+                tested += len(shadows)
+                if not any(self.compiled[j].contains(lat, lng) for j in shadows):
+                    return self.names[i], tested
+                # An earlier district also has the point; settle it with the full scan
+                outside.update(j for j in shadows if not self.compiled[j].contains(lat, lng))
+                break
+        for i in self.candidates(lat, lng):
+            if i in outside:
+                continue
+            tested += 1
+            if self.compiled[i].contains(lat, lng):
+                return self.names[i], tested
+        return None, tested
+
+    def within(self, i, lat, lng, meters):
+        """True if the point is inside district i or within meters of its boundary"""
+        compiled = self.compiled[i]
+        if compiled.contains(lat, lng):
+            return True
+        # Degrees to meters, flattened at the point's latitude
+        scale = math.cos(math.radians(lat))
+        reach = meters / METERS_PER_DEGREE
+        min_lat, min_lng, max_lat, max_lng = compiled.bbox
+        if lat < min_lat - reach or lat > max_lat + reach or \
+                lng < min_lng - reach / max(scale, 1e-6) or lng > max_lng + reach / max(scale, 1e-6):
+            return False
+        lats, lngs = compiled.lats, compiled.lngs
+        reach_sq = reach * reach
+        j = len(lats) - 1
+        for k in range(len(lats)):
+            if _segment_distance_sq(lat, lng * scale, lats[j], lngs[j] * scale,
+                                    lats[k], lngs[k] * scale) <= reach_sq:
+                return True
+            j = k
+        return False
+
+    # Upper bound on points x edges evaluated at once by classify()
+    BLOCK_ELEMENTS = 1 << 20
+
+    def classify(self, lats, lngs):
+        """
+        Vectorized lookup for many points at once.
+
+        Returns an int array of district indices (into self.names), -1 for points
+        outside every district. Each district is tested, in order, only against
+        the still-unassigned points inside its bounding box, all edges at once.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        if self.raster is None:
+            return self._classify_edges(lats, lngs, np.full(lats.shape, -1, dtype=np.int64))
+        result = self.raster.lookup_many(lats, lngs)
+        return self._classify_edges(lats, lngs, result, result == DistrictRaster.BOUNDARY)
+
+    def _classify_edges(self, lats, lngs, result, todo=None):
+        """Ray-cast the points where todo is set (all of them by default) into result"""
+        if todo is not None:
+            result[todo] = -1
+        for i, compiled in enumerate(self.compiled):
+            min_lat, min_lng, max_lat, max_lng = compiled.bbox
+            unassigned = result == -1
+            if todo is not None:
+                unassigned &= todo
+            pending = np.flatnonzero(unassigned &
+                                     (lats >= min_lat) & (lats <= max_lat) &
+                                     (lngs >= min_lng) & (lngs <= max_lng))
+            if not len(pending) or not len(compiled.edge_lo):
+                continue
+
+            lo = np.frombuffer(compiled.edge_lo)
+            hi = np.frombuffer(compiled.edge_hi)
+            y0 = np.frombuffer(compiled.edge_lat)
+            x0 = np.frombuffer(compiled.edge_lng)
+            slope = np.frombuffer(compiled.edge_slope)
+
+            block = max(1, self.BLOCK_ELEMENTS // len(lo))
+            for start in range(0, len(pending), block):
+                points = pending[start:start + block]
+                y = lats[points, None]
+                x = lngs[points, None]
+                crossings = (lo <= y) & (y < hi) & (x < x0 + slope * (y - y0))
+                inside = np.count_nonzero(crossings, axis=1) & 1
+                result[points[inside.astype(bool)]] = i
+
+        return result
+
+
+class DistrictRaster:
+    """
+    A fine grid over a DistrictIndex's extent that answers most lookups outright.
+
+    A cell that no district edge touches lies wholly inside or wholly outside
+    every polygon, so the lookup answer at its centre holds for the whole
+    cell: the index of the first containing district, or OUTSIDE. Cells an
+    edge passes through (or grazes) are marked BOUNDARY and left to the exact
+    test. The grid uses roughly square cells, as many as fit in max_bytes.
+    """
+
+    OUTSIDE = -1
+    BOUNDARY = -2
+    MAX_CELLS_PER_AXIS = 4096
+
+    def __init__(self, index, max_bytes):
+        self.dtype = np.dtype(np.int16 if len(index) < np.iinfo(np.int16).max else np.int32)
+        budget = max(1, max_bytes // self.dtype.itemsize)
+        min_lat, min_lng, max_lat, max_lng = self.extent = index.extent
+        height, width = max_lat - min_lat, max_lng - min_lng
+
+        side = math.sqrt(max(height, 1e-12) * max(width, 1e-12) / budget)
+        self.rows = max(1, min(self.MAX_CELLS_PER_AXIS, int(height / side)))
+        self.cols = max(1, min(self.MAX_CELLS_PER_AXIS, budget // self.rows))
+        # Guard against degenerate (zero-height or zero-width) extents
+        self.cell_height = height / self.rows or 1.0
+        self.cell_width = width / self.cols or 1.0
+
+        centre_lats = min_lat + (np.arange(self.rows) + 0.5) * self.cell_height
+        centre_lngs = min_lng + (np.arange(self.cols) + 0.5) * self.cell_width
+        lats, lngs = np.meshgrid(centre_lats, centre_lngs, indexing='ij')
+        cells = index._classify_edges(lats.ravel(), lngs.ravel(),
+                                      np.full(lats.size, -1, dtype=np.int64))
+        self.cells = cells.astype(self.dtype).reshape(self.rows, self.cols)
+        for compiled in index.compiled:
+            self._mark_edges(compiled)
+
+    def _mark_edges(self, compiled):
+        """Mark every cell a polygon edge touches as BOUNDARY"""
+        min_lat, min_lng = self.extent[0], self.extent[1]
+        # Grow each edge's footprint slightly so rounding can't miss a cell it grazes
+        eps_lat, eps_lng = self.cell_height * 1e-6, self.cell_width * 1e-6
+        lats, lngs = compiled.lats, compiled.lngs
+        j = len(lats) - 1
+        for i in range(len(lats)):
+            ay, ax, by, bx = lats[j], lngs[j], lats[i], lngs[i]
+            j = i
+            row_lo = self._clamp_row(int((min(ay, by) - eps_lat - min_lat) // self.cell_height))
+            row_hi = self._clamp_row(int((max(ay, by) + eps_lat - min_lat) // self.cell_height))
+            for row in range(row_lo, row_hi + 1):
+                if ay == by:
+                    x_lo, x_hi = min(ax, bx), max(ax, bx)
+                else:
+                    # The part of the edge inside this row's lat band
+                    y_lo = max(min(ay, by), min_lat + row * self.cell_height)
+                    y_hi = min(max(ay, by), min_lat + (row + 1) * self.cell_height)
+                    x1 = ax + (bx - ax) * (y_lo - ay) / (by - ay)
+                    x2 = ax + (bx - ax) * (y_hi - ay) / (by - ay)
+                    x_lo, x_hi = min(x1, x2), max(x1, x2)
+                col_lo = self._clamp_col(int((x_lo - eps_lng - min_lng) // self.cell_width))
+                col_hi = self._clamp_col(int((x_hi + eps_lng - min_lng) // self.cell_width))
+                self.cells[row, col_lo:col_hi + 1] = self.BOUNDARY
+
+    def _clamp_row(self, row):
+        return min(max(row, 0), self.rows - 1)
+
+    def _clamp_col(self, col):
+        return min(max(col, 0), self.cols - 1)
+
+    @property
+    def nbytes(self):
+        return self.cells.nbytes
+
+    def lookup(self, lat, lng):
+        """District index for the point, OUTSIDE, or BOUNDARY when it needs an exact test"""
+        min_lat, min_lng, max_lat, max_lng = self.extent
+        if lat < min_lat or lat > max_lat or lng < min_lng or lng > max_lng:
+            return self.OUTSIDE
+        row = min(int((lat - min_lat) / self.cell_height), self.rows - 1)
+        col = min(int((lng - min_lng) / self.cell_width), self.cols - 1)
+        return int(self.cells[row, col])
+
+    def lookup_many(self, lats, lngs):
+        """Vectorized lookup; returns an int64 array of the same codes"""
+        min_lat, min_lng, max_lat, max_lng = self.extent
+        result = np.full(lats.shape, self.OUTSIDE, dtype=np.int64)
+        inside = (lats >= min_lat) & (lats <= max_lat) & (lngs >= min_lng) & (lngs <= max_lng)
+        rows = np.minimum(((lats[inside] - min_lat) / self.cell_height).astype(np.int64), self.rows - 1)
+        cols = np.minimum(((lngs[inside] - min_lng) / self.cell_width).astype(np.int64), self.cols - 1)
+        result[inside] = self.cells[rows, cols]
+        return result
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'cols': self.cols,
+            'cell_height': self.cell_height,
+            'cell_width': self.cell_width,
+            'bytes': self.nbytes,
+            'boundary_fraction': float(np.count_nonzero(self.cells == self.BOUNDARY)) / self.cells.size,
+        }
@@ -0,0 +1,259 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+# user id, timestamp (epoch seconds), lat, lng, district id
+RECORD = struct.Struct('<IdddH')
+NO_DISTRICT = 0xFFFF
+
+
+class LocationHistory:
+    """
+    Append-only log of every accepted fix.
+
+    Fixes are stored as fixed-width binary records in numbered segment files;
+    usernames and district names are interned into append-only name tables
+    (one JSON string per line, id = line number). Each user's fixes are
+    indexed in memory by timestamp, pointing at record positions, and reads
+    go through memory-mapped segments.
+
+    Appends hold an exclusive flock on the directory's lock file, and every
+    append or query first catches up with records other processes wrote, so
+    several workers can share one history directory.
+    """
+
+    SEGMENT_RECORDS = 1 << 20
+
+    def __init__(self, directory, segment_records=None):
+        self.directory = directory
+        self.segment_records = segment_records or self.SEGMENT_RECORDS
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.lock_file = open(os.path.join(directory, 'lock'), 'a+')
+        self.users = _NameTable(os.path.join(directory, 'users.txt'))
+        self.districts = _NameTable(os.path.join(directory, 'districts.txt'))
+
+        # Per-user index: user id -> (sorted timestamps, record positions)
+        self.times = {}
+        self.positions = {}
+        self.segment = 0
+        self.segment_count = 0
+        self.maps = {}
+
+        with self._locked():
+            self._repair_tail()
+            self._catch_up()
+
+    def _locked(self):
+        return _FileLock(self.lock, self.lock_file)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f'segment-{segment:06d}.bin')
+
+    def _repair_tail(self):
+        """Drop a partial record left at the end of the newest segment by a crash"""
+        segment = 0
+        while os.path.exists(self._segment_path(segment + 1)):
+            segment += 1
+        path = self._segment_path(segment)
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+            if size % RECORD.size:
+                os.truncate(path, size - size % RECORD.size)
+
+    def _catch_up(self):
+        """Index names and records appended since we last looked. Caller holds the lock."""
+        self.users.catch_up()
+        self.districts.catch_up()
+        while True:
+            path = self._segment_path(self.segment)
+            try:
+                if os.path.getsize(path) <= self.segment_count * RECORD.size:
+                    return
+            except OSError:
+                return
+            with open(path, 'rb') as f:
+                f.seek(self.segment_count * RECORD.size)
+                data = f.read()
+            count = len(data) // RECORD.size
+            base = self.segment * self.segment_records + self.segment_count
+            for i, (user_id, ts, _, _, _) in enumerate(RECORD.iter_unpack(data[:count * RECORD.size])):
+                self._index(user_id, ts, base + i)
+            self.segment_count += count
+            if self.segment_count < self.segment_records:
+                return
+            self.segment += 1
+            self.segment_count = 0
+
+    def _index(self, user_id, ts, position):
+        times = self.times.get(user_id)
+        if times is None:
+            times = self.times[user_id] = array('d')
+            self.positions[user_id] = array('Q')
+        positions = self.positions[user_id]
+        if not times or ts >= times[-1]:
+            times.append(ts)
+            positions.append(position)
+        else:
+            # Fixes can arrive out of order; keep the index sorted by time
+            i = bisect_right(times, ts)
+            times.insert(i, ts)
+            positions.insert(i, position)
+
+    def append(self, fixes):
+        """Append (username, timestamp, lat, lng, district) fixes; timestamp in epoch seconds"""
+        if not fixes:
+            return
+        with self._locked():
+            self._catch_up()
+            records = []
+            for username, ts, lat, lng, district in fixes:
+                user_id = self.users.intern(username)
+                district_id = NO_DISTRICT if district is None else self.districts.intern(district)
+                records.append((user_id, ts, lat, lng, district_id))
+
+            # Fill the active segment, rolling over to new ones as they fill up
+            while records:
+                room = self.segment_records - self.segment_count
+                chunk, records = records[:room], records[room:]
+                with open(self._segment_path(self.segment), 'ab') as f:
+                    f.write(b''.join(RECORD.pack(*record) for record in chunk))
+                base = self.segment * self.segment_records + self.segment_count
+                for i, record in enumerate(chunk):
+                    self._index(record[0], record[1], base + i)
+                self.segment_count += len(chunk)
+                if self.segment_count == self.segment_records:
+                    self.segment += 1
+                    self.segment_count = 0
+
+    def _read(self, position):
+        segment, index = divmod(position, self.segment_records)
+        offset = index * RECORD.size
+        mapped = self.maps.get(segment)
+        if mapped is None or len(mapped) < offset + RECORD.size:
+            # The active segment grows, so remap it when a read runs past the end
+            with open(self._segment_path(segment), 'rb') as f:
+                mapped = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return RECORD.unpack_from(mapped, offset)
+
+    def query(self, username, start=None, end=None, limit=None):
+        """Return a user's fixes with start <= timestamp <= end, oldest first"""
+        with self._locked():
+            self._catch_up()
+            user_id = self.users.ids.get(username)
+            if user_id is None:
+                return []
+            times = self.times.get(user_id, ())
+            lo = 0 if start is None else bisect_left(times, start)
+            hi = len(times) if end is None else bisect_right(times, end)
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            positions = self.positions[user_id][lo:hi]
+            records = [self._read(position) for position in positions]
+
+        points = []
+        for _, ts, lat, lng, district_id in records:
+            timestamp = _isoformat(ts)
+            if timestamp is None:
+                # Written before parse_time rejected unrepresentable times; unreadable, so skipped
+                continue
+            points.append({
+                'latitude': lat,
+                'longitude': lng,
+                'timestamp': timestamp,
+                'district': "Outside Districts" if district_id == NO_DISTRICT
+                            else self.districts.names[district_id]
+            })
+        return points
+
+
+class _NameTable:
+    """Append-only name <-> id table, one JSON-encoded name per line"""
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.ids = {}
+        self.offset = 0
+
+    def catch_up(self):
+        try:
+            if os.path.getsize(self.path) <= self.offset:
+                return
+        except OSError:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Only consume complete lines; a partial one is finished by its writer
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            name = json.loads(line)
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        self.offset += end
+
+    def intern(self, name):
+        """Return name's id, appending it to the table if new. Caller holds the file lock."""
+        name_id = self.ids.get(name)
+        if name_id is None:
+            line = (json.dumps(name) + '\n').encode('utf-8')
+            with open(self.path, 'ab') as f:
+                f.write(line)
+            self.offset += len(line)
+            name_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+
+class _FileLock:
+    """Hold a thread lock and an exclusive flock together"""
+
+    def __init__(self, lock, lock_file):
+        self.lock = lock
+        self.lock_file = lock_file
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 string or epoch seconds into epoch seconds, or None.
+
+    Epoch seconds that datetime can't represent (NaN, infinities, 1e20) are
+    None too, so they can never be stored and then fail to format.
+    """
+    if value is None or value == '':
+        return None
+    try:
+        ts = float(value)
+    except (TypeError, ValueError):
+        pass
+    else:
+        return ts if _isoformat(ts) is not None else None
+    try:
+        # Naive timestamps (like the server's own defaults) are local time
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+def _isoformat(ts):
+    """Epoch seconds as an ISO 8601 UTC string, or None if datetime can't represent them"""
+    try:
+        return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+    except (ValueError, OverflowError, OSError):
+        return None
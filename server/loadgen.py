@@ -0,0 +1,382 @@
+"""
+Load generator that simulates a fleet of mobile clients against a running server.
+
+    gunicorn app:app -b 127.0.0.1:5000 --workers 2 --worker-class gthread --threads 64
+    python loadgen.py --url http://127.0.0.1:5000 --devices 500 --readers 10 --duration 120
+
+Each simulated device walks, cycles or drives between random points in the
+server's districts (sometimes stopping for a while), and posts a fix every
+time it has moved the iOS client's distanceFilter (10 m) from the last one,
+so a device at speed v posts every 10/v seconds while moving. Readers follow
+the dashboard: an EventSource on /api/stream by default, or the long-polled
+change feed, or plain polls of the full user list.
+
+Progress goes to stderr; a JSON summary with throughput, p50/p99 latency,
+error counts and (for same-host servers) how stale fixes are when readers
+see them goes to stdout or -o.
+"""
+import argparse
+import heapq
+import http.client
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from bench import percentile
+from geometry import METERS_PER_DEGREE, point_in_polygon
+
+# (name, share of the fleet, speed range in m/s)
+PROFILES = [('walk', 0.6, (1.0, 1.8)), ('cycle', 0.25, (3.5, 7.0)), ('drive', 0.15, (8.0, 15.0))]
+
+
+class Stats:
+    """Latencies and errors per operation, shared by every generator thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = Counter()
+        self.lag = []
+        self.staleness = []
+        self.events = 0
+
+    def record(self, op, latency, error=None):
+        with self.lock:
+            self.latencies.setdefault(op, []).append(latency)
+            if error is not None:
+                self.errors[f'{op}:{error}'] += 1
+
+    def record_lag(self, lag):
+        with self.lock:
+            self.lag.append(lag)
+
+    def record_seen(self, changed):
+        """Note when readers see fixes, against the timestamps the server gave them"""
+        now = datetime.now()
+        with self.lock:
+            self.events += 1
+            for info in changed.values():
+                try:
+                    self.staleness.append((now - datetime.fromisoformat(info['timestamp'])).total_seconds())
+                except (KeyError, TypeError, ValueError):
+                    pass
+
+    def count(self, op):
+        with self.lock:
+            return len(self.latencies.get(op, ()))
+
+    def summary(self, seconds):
+        with self.lock:
+            report = {}
+            for op, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                errors = sum(n for key, n in self.errors.items() if key.startswith(op + ':'))
+                report[op] = {
+                    'count': len(latencies),
+                    'errors': errors,
+                    'error_rate': round(errors / len(latencies), 5) if latencies else 0,
+                    'per_sec': round(len(latencies) / seconds, 1),
+                    'p50_ms': _ms(percentile(latencies, 0.50)),
+                    'p99_ms': _ms(percentile(latencies, 0.99)),
+                    'max_ms': _ms(latencies[-1] if latencies else None),
+                }
+            lag = sorted(self.lag)
+            staleness = sorted(self.staleness)
+            report['send_lag'] = {'p50_ms': _ms(percentile(lag, 0.50)), 'p99_ms': _ms(percentile(lag, 0.99))}
+            report['fanout'] = {'events': self.events, 'fixes_seen': len(staleness),
+                                'staleness_p50_ms': _ms(percentile(staleness, 0.50)),
+                                'staleness_p99_ms': _ms(percentile(staleness, 0.99))}
+            report['errors'] = dict(self.errors)
+            return report
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class Device:
+    """One simulated phone moving between waypoints"""
+
+    def __init__(self, username, profile, speed, position, map_, rng):
+        self.username = username
+        self.profile = profile
+        self.speed = speed
+        self.lat, self.lng = position
+        self.map = map_
+        self.rng = rng
+        self.target = map_.waypoint(rng)
+
+    def advance(self, meters, dwell):
+        """Move meters along the path; returns extra seconds spent stopped at a waypoint"""
+        while meters > 0:
+            d_lat = (self.target[0] - self.lat) * METERS_PER_DEGREE
+            d_lng = (self.target[1] - self.lng) * METERS_PER_DEGREE * math.cos(math.radians(self.lat))
+            remaining = math.hypot(d_lat, d_lng)
+            if remaining > meters:
+                self.lat += (self.target[0] - self.lat) * meters / remaining
+                self.lng += (self.target[1] - self.lng) * meters / remaining
+                return 0.0
+            self.lat, self.lng = self.target
+            meters -= remaining
+            self.target = self.map.waypoint(self.rng)
+            if dwell and self.rng.random() < 0.3:
+                # Stationary phones don't pass the distance filter, so they go quiet
+                return self.rng.uniform(0, dwell)
+        return 0.0
+
+    def fix(self, noise):
+        """Current position with GPS noise (meters, one sigma)"""
+        lat = self.lat + self.rng.gauss(0, noise) / METERS_PER_DEGREE
+        lng = self.lng + self.rng.gauss(0, noise) / (METERS_PER_DEGREE * math.cos(math.radians(self.lat)))
+        return {'username': self.username, 'latitude': round(lat, 7), 'longitude': round(lng, 7)}
+
+
+class DistrictMap:
+    """Waypoint sampler over the server's district map"""
+
+    def __init__(self, districts, outside_share=0.1):
+        self.polygons = [polygon for polygon in districts.values() if len(polygon) >= 3]
+        if not self.polygons:
+            raise ValueError('the server has no usable districts')
+        points = [point for polygon in self.polygons for point in polygon]
+        self.extent = (min(p[0] for p in points), min(p[1] for p in points),
+                       max(p[0] for p in points), max(p[1] for p in points))
+        self.outside_share = outside_share
+
+    def waypoint(self, rng):
+        min_lat, min_lng, max_lat, max_lng = self.extent
+        if rng.random() < self.outside_share:
+            return rng.uniform(min_lat, max_lat), rng.uniform(min_lng, max_lng)
+        polygon = rng.choice(self.polygons)
+        lats = [p[0] for p in polygon]
+        lngs = [p[1] for p in polygon]
+        for _ in range(50):
+            lat, lng = rng.uniform(min(lats), max(lats)), rng.uniform(min(lngs), max(lngs))
+            if point_in_polygon(lat, lng, polygon):
+                return lat, lng
+        return tuple(rng.choice(polygon))
+
+
+class Client:
+    """Keep-alive HTTP connection that reconnects after errors"""
+
+    def __init__(self, url, timeout=30):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None):
+        """Returns (status, body bytes); raises OSError/HTTPException after closing the connection"""
+        reused = self.connection is not None
+        if not reused:
+            self.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            self.close()
+            if not reused:
+                raise
+            # The server closed an idle keep-alive connection; browsers retry those too
+            return self.request(method, path, body)
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def run_writer(url, devices, args, stats, stop_at):
+    """Post fixes for a share of the fleet, each device on its own distance-filter schedule"""
+    client = Client(url)
+    start = time.monotonic()
+    schedule = []
+    for i, device in enumerate(devices):
+        # Stagger the fleet so devices don't all post on the same tick
+        heapq.heappush(schedule, (start + device.rng.uniform(0, args.distance_filter / device.speed), i))
+
+    while schedule:
+        due, i = heapq.heappop(schedule)
+        if due >= stop_at:
+            break
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        stats.record_lag(max(0.0, time.monotonic() - due))
+
+        device = devices[i]
+        body = json.dumps(device.fix(args.gps_noise))
+        sent = time.monotonic()
+        try:
+            status, _ = client.request('POST', '/api/location', body)
+            stats.record('post', time.monotonic() - sent, None if status == 200 else str(status))
+        except (OSError, http.client.HTTPException) as e:
+            stats.record('post', time.monotonic() - sent, type(e).__name__)
+
+        stopped = device.advance(args.distance_filter, args.dwell)
+        heapq.heappush(schedule, (due + args.distance_filter / device.speed + stopped, i))
+    client.close()
+
+
+def run_reader(url, args, stats, stop_at):
+    if args.reader_mode == 'stream':
+        _read_stream(url, stats, stop_at)
+    else:
+        _read_polling(url, args, stats, stop_at)
+
+
+def _read_stream(url, stats, stop_at):
+    """Follow /api/stream like the dashboard's EventSource"""
+    client = Client(url, timeout=max(30, stop_at - time.monotonic() + 30))
+    while time.monotonic() < stop_at:
+        try:
+            client.connection = client.connection_class(client.host, client.port, timeout=client.timeout)
+            sent = time.monotonic()
+            client.connection.request('GET', '/api/stream')
+            response = client.connection.getresponse()
+            stats.record('stream_connect', time.monotonic() - sent,
+                         None if response.status == 200 else str(response.status))
+            event = None
+            while time.monotonic() < stop_at:
+                line = response.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8').rstrip('\n')
+                if line.startswith('event: '):
+                    event = line[7:]
+                elif line.startswith('data: ') and event == 'location':
+                    stats.record_seen(json.loads(line[6:]).get('changed', {}))
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            stats.record('stream_connect', 0.0, type(e).__name__)
+            time.sleep(1)
+        finally:
+            client.close()
+
+
+def _read_polling(url, args, stats, stop_at):
+    """Poll /api/user_districts: long-polled change feed, or full snapshots on an interval"""
+    client = Client(url, timeout=60)
+    seq = None
+    while time.monotonic() < stop_at:
+        if args.reader_mode == 'poll':
+            path, op = '/api/user_districts', 'read'
+        elif seq is None:
+            # Like the dashboard, start with everything since 0 and follow on from its seq
+            path, op = '/api/user_districts?since=0', 'read'
+        else:
+            path, op = f'/api/user_districts?since={seq}&wait=25', 'longpoll'
+        sent = time.monotonic()
+        try:
+            status, body = client.request('GET', path)
+        except (OSError, http.client.HTTPException) as e:
+            stats.record(op, time.monotonic() - sent, type(e).__name__)
+            time.sleep(1)
+            continue
+        stats.record(op, time.monotonic() - sent, None if status == 200 else str(status))
+        if status != 200:
+            time.sleep(1)
+            continue
+        if args.reader_mode == 'poll':
+            time.sleep(args.poll_interval)
+            continue
+        data = json.loads(body)
+        if seq is not None and not data.get('full'):
+            stats.record_seen(data.get('changed', {}))
+        seq = data.get('seq', seq or 0)
+    client.close()
+
+
+def build_fleet(count, district_map, seed):
+    rng = random.Random(seed)
+    devices = []
+    for i in range(count):
+        device_rng = random.Random(rng.random())
+        roll, share = device_rng.random(), 0
+        for profile, fraction, (low, high) in PROFILES:
+            share += fraction
+            if roll < share:
+                break
+        devices.append(Device(f'loadgen-{i}', profile, device_rng.uniform(low, high),
+                              district_map.waypoint(device_rng), district_map, device_rng))
+    return devices
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a fleet of mobile clients against the server.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--readers', type=int, default=5)
+    parser.add_argument('--reader-mode', choices=('stream', 'longpoll', 'poll'), default='stream')
+    parser.add_argument('--poll-interval', type=float, default=2.0, help='seconds between polls in poll mode')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds to run')
+    parser.add_argument('--connections', type=int, default=16, help='writer connections the fleet shares')
+    parser.add_argument('--distance-filter', type=float, default=10.0, help='meters between fixes')
+    parser.add_argument('--gps-noise', type=float, default=3.0, help='GPS error in meters (one sigma)')
+    parser.add_argument('--dwell', type=float, default=60.0, help='longest stop at a waypoint, seconds')
+    parser.add_argument('--report-interval', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write the JSON summary here (default: stdout)')
+    args = parser.parse_args(argv)
+
+    try:
+        status, body = Client(args.url).request('GET', '/api/districts')
+        district_map = DistrictMap(json.loads(body))
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        print(f'loadgen: cannot load districts from {args.url}: {e}', file=sys.stderr)
+        return 1
+
+    devices = build_fleet(args.devices, district_map, args.seed)
+    stats = Stats()
+    start = time.monotonic()
+    stop_at = start + args.duration
+    connections = max(1, min(args.connections, len(devices)))
+    writers = [threading.Thread(target=run_writer, args=(args.url, devices[i::connections], args, stats, stop_at),
+                                daemon=True) for i in range(connections) if devices[i::connections]]
+    readers = [threading.Thread(target=run_reader, args=(args.url, args, stats, stop_at), daemon=True)
+               for _ in range(args.readers)]
+    for thread in writers + readers:
+        thread.start()
+
+    profiles = Counter(device.profile for device in devices)
+    print(f"{len(devices)} devices ({', '.join(f'{n} {p}' for p, n in profiles.items())}), "
+          f"{args.readers} {args.reader_mode} readers, {args.duration:.0f}s", file=sys.stderr)
+    posted = 0
+    while time.monotonic() < stop_at:
+        time.sleep(min(args.report_interval, max(0, stop_at - time.monotonic())))
+        count = stats.count('post')
+        print(f"t={time.monotonic() - start:5.0f}s  posts {count:>8} (+{count - posted}) "
+              f"errors {sum(stats.errors.values())}", file=sys.stderr)
+        posted = count
+    for thread in writers:
+        thread.join()
+    # Readers may be parked in a long poll; their results so far are enough
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'seconds': round(time.monotonic() - start, 3),
+        **stats.summary(time.monotonic() - start),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+import math
+import threading
+import time
+from bisect import bisect_left
+
+# Request latencies, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Sub-millisecond operations (lookups, lock waits)
+FAST_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.1, 1)
+
+
+class Registry:
+    """A set of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def gauge(self, name, help, function):
+        """A gauge whose value is read from function() at scrape time"""
+        return self._add(Gauge(self.prefix + name, help, function))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def _unlabelled(self):
+        # Metrics without labels have exactly one child; bind it up front
+        # so the hot path skips the children lookup
+        return self.labels() if not self.label_names else None
+
+    def labels(self, *values):
+        """The child for one combination of label values, created on first use"""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'{self.name} takes labels {self.label_names}')
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels):
+        super().__init__(name, help, labels)
+        self.default = self._unlabelled()
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            yield f'{self.name}_total{self._label_text(values)} {_number(child.value)}'
+
+
+class _CounterChild:
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.default = self._unlabelled()
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+            count = sum(counts)
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = '+Inf' if bound == math.inf else _number(bound)
+                yield f'{self.name}_bucket{self._label_text(values, [("le", le)])} {cumulative}'
+            yield f'{self.name}_sum{self._label_text(values)} {_number(total)}'
+            yield f'{self.name}_count{self._label_text(values)} {count}'
+
+
+class _HistogramChild:
+    __slots__ = ('lock', 'buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        # One slot per bucket plus +Inf; made cumulative (and totalled into
+        # the count) only when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, function):
+        super().__init__(name, help, ())
+        self.function = function
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception:
+            # A broken gauge shouldn't take the whole scrape down
+            return
+        yield f'{self.name} {_number(value)}'
+
+
+class TimedLock:
+    """
+    Wrap a lock to record how long acquirers wait for it and how long it is held.
+
+    Works as the lock of a threading.Condition: time spent inside wait() is
+    neither wait nor hold time.
+    """
+
+    __slots__ = ('lock', 'wait', 'hold', 'acquired_at')
+
+    def __init__(self, lock, wait, hold):
+        self.lock = lock
+        self.wait = wait
+        self.hold = hold
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            # Only the holder writes this, so it needs no extra locking
+            self.acquired_at = time.perf_counter()
+            self.wait.observe(self.acquired_at - start)
+        return acquired
+
+    def release(self):
+        self.hold.observe(time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    # threading.Condition hooks, so a condition wait isn't counted as lock wait
+    def _release_save(self):
+        self.release()
+
+    def _acquire_restore(self, state):
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+
+    def _is_owned(self):
+        return self.lock.locked()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
@@ -0,0 +1,58 @@
+import gzip
+import hashlib
+
+from flask import Response, request
+from werkzeug.http import quote_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class PreparedBody:
+    """
+    A response body serialized and compressed once, ahead of the requests that serve it.
+
+    Holds the identity bytes, gzip (and brotli, when the brotli package is
+    installed) copies, and a strong ETag per encoding derived from the content.
+    """
+
+    def __init__(self, body, mimetype='application/json'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.encodings = {'identity': body, 'gzip': gzip.compress(body, compresslevel=6)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # Strong validators must differ between encodings of the same content
+        self.etags = {encoding: digest if encoding == 'identity' else f'{digest}-{encoding}'
+                      for encoding in self.encodings}
+
+    def __len__(self):
+        return len(self.encodings['identity'])
+
+    def response(self, cache_control='no-cache'):
+        """Serve the body for the current request, honouring If-None-Match and Accept-Encoding"""
+        status, body, headers = self.select(request.if_none_match, request.accept_encodings, cache_control)
+        return Response(body, status=status, mimetype=self.mimetype, headers=headers)
+
+    def select(self, if_none_match, accept_encodings, cache_control='no-cache'):
+        """
+        Pick (status, body, headers) for parsed If-None-Match and Accept-Encoding values.
+
+        Framework-neutral, so servers other than Flask can reuse the negotiation.
+        """
+        headers = {'Cache-Control': cache_control, 'Vary': 'Accept, Accept-Encoding'}
+        for encoding, etag in self.etags.items():
+            if if_none_match.contains(etag):
+                headers['ETag'] = quote_etag(etag)
+                return 304, b'', headers
+
+        encoding = max((e for e in ('br', 'gzip') if e in self.encodings and accept_encodings[e]),
+                       key=lambda e: accept_encodings[e], default='identity')
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        headers['ETag'] = quote_etag(self.etags[encoding])
+        return 200, self.encodings[encoding], headers
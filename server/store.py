@@ -0,0 +1,954 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+from zlib import crc32
+
+
+class UserLocation:
+    """A user's latest fix. Treated as immutable: updates replace the record."""
+
+    __slots__ = ('latitude', 'longitude', 'timestamp', 'district')
+
+    def __init__(self, latitude, longitude, timestamp, district):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timestamp = timestamp
+        self.district = district
+
+    def with_district(self, district):
+        return UserLocation(self.latitude, self.longitude, self.timestamp, district)
+
+    def to_dict(self):
+        return {
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'timestamp': self.timestamp,
+            'district': self.district
+        }
+
+
+class _Shard:
+    __slots__ = ('lock', 'records', 'cells', 'sums', 'districts')
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.records = {}
+        # Usernames by grid cell and by district, kept in step with records,
+        # plus each cell's [latitude sum, longitude sum] for cluster centroids
+        self.cells = {}
+        self.sums = {}
+        self.districts = {}
+
+
+def _plain_lock(name, lock):
+    return lock
+
+
+def _cell(record, size):
+    """The (row, col) grid cell of a record's position, or None if it has no numeric position"""
+    try:
+        return math.floor(float(record.latitude) / size), math.floor(float(record.longitude) / size)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _matches(record, bbox, district):
+    """True if record is inside bbox (min_lat, min_lng, max_lat, max_lng) and in district; None means any"""
+    if district is not None and record.district != district:
+        return False
+    if bbox is None:
+        return True
+    try:
+        lat, lng = float(record.latitude), float(record.longitude)
+    except (TypeError, ValueError):
+        return False
+    return bbox[0] <= lat <= bbox[2] and bbox[1] <= lng <= bbox[3]
+
+
+def _filtered_feed(seq, changes, bbox, district):
+    """Split (username, record or None) changes into a feed response for one filter"""
+    changed, removed = {}, []
+    for username, record in changes:
+        # A user who moved out of the filter is gone as far as this client is concerned
+        if record is not None and _matches(record, bbox, district):
+            changed[username] = record.to_dict()
+        else:
+            removed.append(username)
+    return {'seq': seq, 'full': False, 'changed': changed, 'removed': removed}
+
+
+def _index_add(index, key, username):
+    if key is not None:
+        index.setdefault(key, set()).add(username)
+
+
+def _index_discard(index, key, username):
+    members = index.get(key)
+    if members is not None:
+        members.discard(username)
+        if not members:
+            del index[key]
+
+
+def _cell_inside(key, size, bbox):
+    """True if grid cell key lies wholly inside bbox, with a little slack for rounding"""
+    if bbox is None:
+        return True
+    slack = size * 1e-6
+    return key[0] * size > bbox[0] + slack and (key[0] + 1) * size < bbox[2] - slack and \
+        key[1] * size > bbox[1] + slack and (key[1] + 1) * size < bbox[3] - slack
+
+
+def _add_to_cluster(totals, cluster, count, lat_sum, lng_sum, username):
+    """Fold count users into a cluster; username names one of them, kept in case it stays a cluster of one"""
+    total = totals.get(cluster)
+    if total is None:
+        totals[cluster] = [count, lat_sum, lng_sum, username]
+    else:
+        total[0] += count
+        total[1] += lat_sum
+        total[2] += lng_sum
+
+
+def _cluster_list(totals):
+    clusters = []
+    for key in sorted(totals):
+        count, lat_sum, lng_sum, username = totals[key]
+        cluster = {'latitude': lat_sum / count, 'longitude': lng_sum / count, 'count': count}
+        if count == 1:
+            cluster['username'] = username
+        clusters.append(cluster)
+    return clusters
+
+
+def _moved(previous, record):
+    """True if going from record previous to record (either may be None) changes district"""
+    return (previous.district if previous else None) != (record.district if record else None)
+
+
+def _transition(transition_id, username, previous, record):
+    # A removal is reported at the user's last known position
+    position = record or previous
+    return {
+        'id': transition_id,
+        'username': username,
+        'from': previous.district if previous else None,
+        'to': record.district if record else None,
+        'latitude': position.latitude,
+        'longitude': position.longitude,
+        'timestamp': position.timestamp
+    }
+
+
+def _transition_page(last, found, limit, truncated):
+    """A transitions_since response; id is where the next call should continue from"""
+    page = found[:limit]
+    # A cut-short page continues after its last entry, a complete one after the whole log
+    next_id = page[-1]['id'] if len(found) > limit else last
+    return {'id': next_id, 'truncated': truncated, 'transitions': page}
+
+
+class LocationStore:
+    """
+    Latest location per user, split across lock-striped shards.
+
+    Writers lock only the shard their username hashes to. Readers never lock:
+    records are replaced rather than mutated and each shard's dict is copied
+    in one step, so a snapshot is consistent per shard (not across shards).
+
+    Every change also takes the next sequence number in a change log ordered
+    by each user's last change, which backs the ?since= feed. The log has its
+    own short critical section and is written after the shard, so any change
+    a feed reader sees is already visible in the shards.
+
+    timed_lock(name, lock), if given, may wrap each lock ('shard' or 'feed')
+    to measure contention.
+
+    Each shard also indexes its users by grid cell (CELL_DEGREES on a side)
+    and by district, so queries filtered to a bounding box or a district
+    touch only the users that can match. Those queries briefly lock each shard.
+
+    Writes that move a user into a different district (including appearing
+    or being removed) are also kept in a transition log of the last
+    transition_log entries, numbered by their own id. on_transitions, if set,
+    is called with each write's new transitions after its locks are released.
+
+    With a ttl, expire() removes users whose last fix is older than ttl
+    seconds; with max_users, a fix that takes the store past max_users evicts
+    the least recently seen users until it is back at the cap. Both read one
+    recency order of every user, least recent first, under its own short
+    lock ('recency'); every user has the same ttl, so that order is also the
+    expiry order and each expiry or eviction is O(1). on_removed(usernames,
+    seq), if set, hears about every removal. Removed users stay in the change
+    log as tombstones, of which the newest max_tombstones are kept; a feed
+    reader from before the oldest dropped tombstone gets a full snapshot.
+    """
+
+    # State lives in this process only
+    shared = False
+
+    # Side of the grid cells indexing user positions, in degrees (about 1 km)
+    CELL_DEGREES = 0.01
+
+    def __init__(self, shards=16, timed_lock=None, transition_log=10000, ttl=0, max_users=0,
+                 max_tombstones=10000):
+        wrap = timed_lock or _plain_lock
+        self.shards = [_Shard(wrap('shard', threading.Lock())) for _ in range(max(1, shards))]
+        self.ttl = ttl
+        self.max_users = max_users
+        self.tracking = bool(ttl or max_users)
+        # Monotonic time of every user's last fix, least recent first; only kept when tracking
+        self.recency = OrderedDict()
+        self.recency_lock = wrap('recency', threading.Lock())
+        self.seq = 0
+        self.changes = OrderedDict()
+        # Removed users still in changes, oldest first, and the newest seq of any dropped from it
+        self.tombstones = OrderedDict()
+        self.max_tombstones = max_tombstones
+        self.horizon = 0
+        self.on_removed = None
+        self.feed_lock = wrap('feed', threading.Lock())
+        self.changed = threading.Condition(self.feed_lock)
+        self.transitions = deque(maxlen=transition_log)
+        self.transition_id = 0
+        self.on_transitions = None
+
+    def _shard(self, username):
+        return self.shards[crc32(username.encode('utf-8')) % len(self.shards)]
+
+    def _log(self, usernames, removed=()):
+        """Give changed and removed users the next sequence numbers; returns the last one"""
+        with self.feed_lock:
+            for username in usernames:
+                self.seq += 1
+                self.changes[username] = self.seq
+                self.changes.move_to_end(username)
+                self.tombstones.pop(username, None)
+            for username in removed:
+                self.seq += 1
+                self.changes[username] = self.seq
+                self.changes.move_to_end(username)
+                self.tombstones[username] = self.seq
+                self.tombstones.move_to_end(username)
+            while len(self.tombstones) > self.max_tombstones:
+                username, seq = self.tombstones.popitem(last=False)
+                del self.changes[username]
+                self.horizon = seq
+            self.changed.notify_all()
+            return self.seq
+
+    def _log_transitions(self, moves):
+        """
+        Number and keep (username, previous, record) moves; returns the new transitions.
+
+        Called with the users' shard lock held, so one user's transitions are
+        logged in the order their writes happened.
+        """
+        with self.feed_lock:
+            logged = []
+            for username, previous, record in moves:
+                self.transition_id += 1
+                logged.append(_transition(self.transition_id, username, previous, record))
+            self.transitions.extend(logged)
+            return logged
+
+    def _notify(self, transitions, removed=(), seq=None):
+        if transitions and self.on_transitions is not None:
+            self.on_transitions(transitions)
+        if removed and self.on_removed is not None:
+            self.on_removed(removed, seq)
+
+    def _touch(self, username):
+        """
+        Mark username as just seen; call with its shard lock held.
+
+        Returns the least recently seen users beyond max_users, already taken
+        out of the recency order, for _evict to remove.
+        """
+        if not self.tracking:
+            return ()
+        with self.recency_lock:
+            self.recency[username] = time.monotonic()
+            self.recency.move_to_end(username)
+            victims = []
+            while self.max_users and len(self.recency) > self.max_users:
+                victims.append(self.recency.popitem(last=False)[0])
+            return victims
+
+    def _evict(self, victims):
+        """
+        Remove users taken out of the recency order; returns (removed, transitions).
+
+        A victim with a newer fix since it was taken out is back in the order
+        and stays, so only users that are still stale are removed.
+        """
+        removed, transitions = [], []
+        for username in victims:
+            shard = self._shard(username)
+            with shard.lock:
+                if username not in shard.records:
+                    continue
+                with self.recency_lock:
+                    if username in self.recency:
+                        continue
+                previous = self._drop(shard, username)
+                transitions.extend(self._log_transitions(((username, previous, None),)))
+            removed.append(username)
+        return removed, transitions
+
+    def _drop(self, shard, username):
+        """Remove username from the shard, its indexes and the recency order; returns the record it had"""
+        previous = shard.records.pop(username)
+        self._reindex(shard, username, previous, None)
+        if self.tracking:
+            with self.recency_lock:
+                self.recency.pop(username, None)
+        return previous
+
+    def __len__(self):
+        return sum(len(shard.records) for shard in self.shards)
+
+    def get(self, username):
+        return self._shard(username).records.get(username)
+
+    def _reindex(self, shard, username, previous, record):
+        """Move username between the shard's cell and district indexes; call with the shard lock held"""
+        old_cell = _cell(previous, self.CELL_DEGREES) if previous is not None else None
+        new_cell = _cell(record, self.CELL_DEGREES) if record is not None else None
+        if old_cell != new_cell or previous is None or record is None:
+            _index_discard(shard.cells, old_cell, username)
+            _index_add(shard.cells, new_cell, username)
+        if old_cell is not None:
+            if old_cell in shard.cells:
+                sums = shard.sums[old_cell]
+                sums[0] -= float(previous.latitude)
+                sums[1] -= float(previous.longitude)
+            else:
+                # Dropping emptied cells also stops rounding error piling up
+                del shard.sums[old_cell]
+        if new_cell is not None:
+            sums = shard.sums.setdefault(new_cell, [0.0, 0.0])
+            sums[0] += float(record.latitude)
+            sums[1] += float(record.longitude)
+        old_district = previous.district if previous is not None else None
+        new_district = record.district if record is not None else None
+        if old_district != new_district:
+            _index_discard(shard.districts, old_district, username)
+            _index_add(shard.districts, new_district, username)
+
+    def items(self, bbox=None, district=None):
+        """
+        Snapshot of (username, record) pairs, optionally only those in bbox and district.
+
+        bbox is (min_lat, min_lng, max_lat, max_lng). An unfiltered snapshot is
+        taken without locking.
+        """
+        items = []
+        if bbox is None and district is None:
+            for shard in self.shards:
+                items.extend(dict(shard.records).items())
+            return items
+        for shard in self.shards:
+            with shard.lock:
+                for username in self._candidates(shard, bbox, district):
+                    record = shard.records[username]
+                    if _matches(record, bbox, district):
+                        items.append((username, record))
+        return items
+
+    def _candidates(self, shard, bbox, district):
+        if district is not None:
+            return list(shard.districts.get(district, ()))
+        return [username for key in self._cell_keys(shard, bbox) for username in shard.cells[key]]
+
+    def _cell_keys(self, shard, bbox):
+        """The shard's occupied cells overlapping bbox (all of them for None)"""
+        if bbox is None:
+            return list(shard.cells)
+        size = self.CELL_DEGREES
+        rows = range(math.floor(bbox[0] / size), math.floor(bbox[2] / size) + 1)
+        cols = range(math.floor(bbox[1] / size), math.floor(bbox[3] / size) + 1)
+        if len(rows) * len(cols) > len(shard.cells):
+            # A viewport wider than the occupied area; walk what is occupied instead
+            return [key for key in shard.cells if key[0] in rows and key[1] in cols]
+        return [(row, col) for row in rows for col in cols if (row, col) in shard.cells]
+
+    def clusters(self, bbox=None, cell_degrees=CELL_DEGREES):
+        """
+        Group users in bbox into square cells cell_degrees on a side.
+
+        Returns [{'latitude', 'longitude', 'count'}] with each cluster at its
+        users' centroid, plus 'username' for a cluster of one. Cells that are
+        a whole multiple of CELL_DEGREES are built from the index's per-cell
+        sums, so the work depends on occupied cells rather than users; only
+        cells cut by the bbox edge, or clusters finer than the index, visit
+        individual users.
+        """
+        size = self.CELL_DEGREES
+        factor = round(cell_degrees / size)
+        per_user = factor < 1 or abs(factor * size - cell_degrees) > size * 1e-9
+        totals = {}
+        for shard in self.shards:
+            with shard.lock:
+                for key in self._cell_keys(shard, bbox):
+                    members = shard.cells[key]
+                    if not per_user and _cell_inside(key, size, bbox):
+                        lat_sum, lng_sum = shard.sums[key]
+                        _add_to_cluster(totals, (key[0] // factor, key[1] // factor), len(members),
+                                        lat_sum, lng_sum, next(iter(members)))
+                        continue
+                    for username in members:
+                        record = shard.records[username]
+                        if bbox is not None and not _matches(record, bbox, None):
+                            continue
+                        lat, lng = float(record.latitude), float(record.longitude)
+                        cluster = (math.floor(lat / cell_degrees), math.floor(lng / cell_degrees)) if per_user \
+                            else (key[0] // factor, key[1] // factor)
+                        _add_to_cluster(totals, cluster, 1, lat, lng, username)
+        return _cluster_list(totals)
+
+    def district_counts(self):
+        """Users per district, read from the district index without locking"""
+        counts = {}
+        for shard in self.shards:
+            for district, members in dict(shard.districts).items():
+                counts[district] = counts.get(district, 0) + len(members)
+        return counts
+
+    def snapshot(self, bbox=None, district=None):
+        """Snapshot as {username: dict}, for JSON responses"""
+        return {username: record.to_dict() for username, record in self.items(bbox, district)}
+
+    def put(self, username, record):
+        shard = self._shard(username)
+        transitions = []
+        with shard.lock:
+            previous = shard.records.get(username)
+            shard.records[username] = record
+            self._reindex(shard, username, previous, record)
+            victims = self._touch(username)
+            if _moved(previous, record):
+                transitions = self._log_transitions(((username, previous, record),))
+        evicted, evictions = self._evict(victims) if victims else ((), ())
+        seq = self._log((username,), evicted)
+        self._notify(transitions + list(evictions), evicted, seq)
+        return seq
+
+    def put_many(self, items):
+        """Store (username, record) pairs in order, locking each shard once"""
+        by_shard = {}
+        for username, record in items:
+            by_shard.setdefault(self._shard(username), []).append((username, record))
+        transitions, victims = [], []
+        for shard, group in by_shard.items():
+            with shard.lock:
+                moves = []
+                for username, record in group:
+                    previous = shard.records.get(username)
+                    shard.records[username] = record
+                    self._reindex(shard, username, previous, record)
+                    if _moved(previous, record):
+                        moves.append((username, previous, record))
+                if moves:
+                    transitions.extend(self._log_transitions(moves))
+        if self.tracking:
+            # Touch users in the order of their last fix in items, not shard by shard
+            for username in reversed(dict.fromkeys(username for username, _ in reversed(items))):
+                shard = self._shard(username)
+                with shard.lock:
+                    # Unless removed meanwhile, which would leave them in the order without a record
+                    if username in shard.records:
+                        victims.extend(self._touch(username))
+        evicted, evictions = self._evict(victims) if victims else ((), ())
+        transitions.extend(evictions)
+        # The last write per user wins, matching the order of items
+        seq = self._log(dict.fromkeys(username for username, _ in items), evicted)
+        self._notify(transitions, evicted, seq)
+        return seq
+
+    def replace_if(self, username, expected, record):
+        """Swap in record only if the user's current record is still expected"""
+        shard = self._shard(username)
+        transitions = ()
+        with shard.lock:
+            if shard.records.get(username) is not expected:
+                return None
+            shard.records[username] = record
+            self._reindex(shard, username, expected, record)
+            if _moved(expected, record):
+                transitions = self._log_transitions(((username, expected, record),))
+        seq = self._log((username,))
+        self._notify(transitions)
+        return seq
+
+    def expire(self, now=None):
+        """Remove users whose last fix is more than ttl seconds before now (time.monotonic()); returns how many"""
+        if not self.ttl:
+            return 0
+        cutoff = (time.monotonic() if now is None else now) - self.ttl
+        victims = []
+        with self.recency_lock:
+            while self.recency:
+                username, seen = next(iter(self.recency.items()))
+                if seen > cutoff:
+                    break
+                self.recency.popitem(last=False)
+                victims.append(username)
+        removed, transitions = self._evict(victims)
+        if not removed:
+            return 0
+        seq = self._log((), removed)
+        self._notify(transitions, removed, seq)
+        return len(removed)
+
+    def transitions_since(self, since, username=None, limit=1000):
+        """
+        Transitions numbered after since, oldest first, at most limit of them.
+
+        truncated is set when entries after since have already been dropped
+        from the log; a since ahead of the log (e.g. after a restart) starts
+        over from the oldest entry kept.
+        """
+        with self.feed_lock:
+            last = self.transition_id
+            oldest = last - len(self.transitions) + 1
+            if since > last:
+                since = 0
+            # Ids in the log are consecutive, so skip straight past since
+            entries = list(islice(self.transitions, max(0, since - oldest + 1), None))
+        found = [t for t in entries if username is None or t['username'] == username]
+        return _transition_page(last, found, limit, truncated=since < oldest - 1)
+
+    def changes_since(self, since, wait=0, bbox=None, district=None):
+        """
+        Users changed after sequence number since, as a change-feed response.
+
+        Waits up to wait seconds for a change when there is nothing new. A
+        since ahead of the store (e.g. after a restart) returns everything.
+
+        With bbox or district, changed holds only users that match, and users
+        that changed but no longer match are listed as removed. Starting such
+        a feed from since=0 reads the index instead of the whole change log.
+        """
+        filtered = bbox is not None or district is not None
+        with self.feed_lock:
+            deadline = time.monotonic() + wait
+            while self.seq == since and wait > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.changed.wait(remaining):
+                    break
+            seq = self.seq
+            # Removals at or before the horizon may have been forgotten
+            if since > seq or since < self.horizon or (filtered and since == 0):
+                usernames, full = None, True
+            else:
+                usernames, full = [], False
+                for username, changed_seq in reversed(self.changes.items()):
+                    if changed_seq <= since:
+                        break
+                    usernames.append(username)
+
+        if full:
+            return {'seq': seq, 'full': True, 'changed': self.snapshot(bbox, district), 'removed': []}
+        if filtered:
+            return _filtered_feed(seq, ((username, self.get(username)) for username in usernames),
+                                  bbox, district)
+        changed, removed = {}, []
+        for username in usernames:
+            record = self.get(username)
+            if record is not None:
+                changed[username] = record.to_dict()
+            else:
+                removed.append(username)
+        return {'seq': seq, 'full': False, 'changed': changed, 'removed': removed}
+
+
+class SqliteLocationStore:
+    """
+    LocationStore backed by a SQLite database in WAL mode.
+
+    Lets several gunicorn workers (or anything else on the same machine) share
+    one view of user locations. Writes are serialized by SQLite; the change
+    feed's sequence number is allocated inside the write transaction, so a
+    reader never sees a later number before an earlier one has committed.
+    Removed users stay behind as tombstone rows so the feed can report them.
+
+    Writers in one process queue on a lock before BEGIN IMMEDIATE rather than
+    spinning in SQLite's busy handler; timed_lock may wrap it as 'sqlite_write'.
+
+    District transitions go to a transitions table in the same transaction
+    as the write, trimmed to roughly the last transition_log rows.
+
+    Users are indexed by when they last reported (wall clock, since
+    processes share it). A write that takes the store past max_users evicts
+    the least recently seen users in the same transaction; expire() removes
+    users silent for ttl seconds and trims tombstones to the newest
+    max_tombstones.
+    """
+
+    shared = True
+
+    # Cluster cells are sized in these units, as for LocationStore
+    CELL_DEGREES = LocationStore.CELL_DEGREES
+
+    # How often a long-poll re-checks the database for changes
+    POLL_INTERVAL = 0.25
+    # Trim the transitions table once per this many transitions
+    TRIM_EVERY = 1000
+    # Users removed per expire() transaction, so writers aren't held up for long
+    EXPIRE_BATCH = 1000
+
+    def __init__(self, path, timed_lock=None, transition_log=10000, ttl=0, max_users=0,
+                 max_tombstones=10000):
+        self.path = path
+        self.transition_log = transition_log
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_tombstones = max_tombstones
+        self.on_transitions = None
+        self.on_removed = None
+        self.local = threading.local()
+        self.write_lock = (timed_lock or _plain_lock)('sqlite_write', threading.Lock())
+        # executescript manages its own transaction
+        self._connect().db.executescript('''
+            CREATE TABLE IF NOT EXISTS locations (
+                username TEXT PRIMARY KEY,
+                latitude REAL,
+                longitude REAL,
+                timestamp TEXT,
+                district TEXT,
+                seq INTEGER NOT NULL,
+                removed INTEGER NOT NULL DEFAULT 0,
+                seen REAL
+            );
+            CREATE INDEX IF NOT EXISTS locations_seq ON locations (seq);
+            CREATE INDEX IF NOT EXISTS locations_position ON locations (latitude, longitude) WHERE removed = 0;
+            CREATE INDEX IF NOT EXISTS locations_district ON locations (district) WHERE removed = 0;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('seq', 0);
+            CREATE TABLE IF NOT EXISTS transitions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                from_district TEXT,
+                to_district TEXT,
+                latitude REAL,
+                longitude REAL,
+                timestamp TEXT
+            );
+            CREATE TABLE IF NOT EXISTS occupancy (district TEXT PRIMARY KEY, users INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('occupancy_built', 0);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('horizon', 0);
+        ''')
+        with self._connect().write() as db:
+            # Databases from before expiry get a last-seen column; their users count as seen now
+            if 'seen' not in [row[1] for row in db.execute('PRAGMA table_info(locations)')]:
+                db.execute('ALTER TABLE locations ADD COLUMN seen REAL')
+                db.execute('UPDATE locations SET seen = ?', (time.time(),))
+            db.execute('CREATE INDEX IF NOT EXISTS locations_seen ON locations (seen) WHERE removed = 0')
+            # Kept up to date by every write, so the cap needn't count rows
+            db.execute("INSERT OR IGNORE INTO meta (key, value) "
+                       "SELECT 'users', count(*) FROM locations WHERE removed = 0")
+            # Databases from before the occupancy table get it filled in once
+            if not db.execute("SELECT value FROM meta WHERE key = 'occupancy_built'").fetchone()[0]:
+                db.execute('INSERT OR REPLACE INTO occupancy (district, users) '
+                           'SELECT district, count(*) FROM locations WHERE removed = 0 AND district IS NOT NULL '
+                           'GROUP BY district')
+                db.execute("UPDATE meta SET value = 1 WHERE key = 'occupancy_built'")
+
+    def _connect(self):
+        """One connection per thread, opened on first use"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return _Transaction(db, self.write_lock)
+
+    @property
+    def seq(self):
+        return self._connect().db.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()[0]
+
+    @property
+    def transition_id(self):
+        return self._connect().db.execute('SELECT coalesce(max(id), 0) FROM transitions').fetchone()[0]
+
+    def __len__(self):
+        with self._connect() as db:
+            return db.execute('SELECT count(*) FROM locations WHERE removed = 0').fetchone()[0]
+
+    def get(self, username):
+        with self._connect() as db:
+            row = db.execute('SELECT latitude, longitude, timestamp, district FROM locations '
+                             'WHERE username = ? AND removed = 0', (username,)).fetchone()
+        return UserLocation(*row) if row else None
+
+    def items(self, bbox=None, district=None):
+        """Same contract as LocationStore.items; filters are range and equality queries on indexed columns"""
+        query = ('SELECT username, latitude, longitude, timestamp, district '
+                 'FROM locations WHERE removed = 0')
+        params = []
+        if bbox is not None:
+            query += ' AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?'
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if district is not None:
+            query += ' AND district = ?'
+            params.append(district)
+        with self._connect() as db:
+            rows = db.execute(query, params).fetchall()
+        return [(row[0], UserLocation(*row[1:])) for row in rows]
+
+    def snapshot(self, bbox=None, district=None):
+        return {username: record.to_dict() for username, record in self.items(bbox, district)}
+
+    def clusters(self, bbox=None, cell_degrees=LocationStore.CELL_DEGREES):
+        """Same contract as LocationStore.clusters, grouped by SQLite"""
+        where = 'removed = 0 AND typeof(latitude) IN (\'real\', \'integer\') ' \
+                'AND typeof(longitude) IN (\'real\', \'integer\')'
+        params = [cell_degrees, cell_degrees]
+        if bbox is not None:
+            where += ' AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?'
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        # floor() without relying on SQLite's optional math functions
+        query = ('SELECT CAST(y AS INTEGER) - (y < CAST(y AS INTEGER)) AS row, '
+                 'CAST(x AS INTEGER) - (x < CAST(x AS INTEGER)) AS col, '
+                 'count(*), avg(latitude), avg(longitude), min(username) '
+                 'FROM (SELECT username, latitude, longitude, latitude / ? AS y, longitude / ? AS x '
+                 f'FROM locations WHERE {where}) GROUP BY row, col ORDER BY row, col')
+        with self._connect() as db:
+            rows = db.execute(query, params).fetchall()
+        clusters = []
+        for row in rows:
+            cluster = {'latitude': row[3], 'longitude': row[4], 'count': row[2]}
+            if row[2] == 1:
+                cluster['username'] = row[5]
+            clusters.append(cluster)
+        return clusters
+
+    def district_counts(self):
+        """Users per district, from the occupancy table kept up to date by every write"""
+        with self._connect() as db:
+            return dict(db.execute('SELECT district, users FROM occupancy WHERE users > 0').fetchall())
+
+    def _current(self, db, username):
+        row = db.execute('SELECT latitude, longitude, timestamp, district FROM locations '
+                         'WHERE username = ? AND removed = 0', (username,)).fetchone()
+        return UserLocation(*row) if row else None
+
+    def _write(self, db, username, record, previous, transitions, seen=None):
+        """Store record (None to remove) as seen at seen, defaulting to now"""
+        seq = db.execute("UPDATE meta SET value = value + 1 WHERE key = 'seq' RETURNING value").fetchone()[0]
+        if record is None:
+            db.execute('UPDATE locations SET removed = 1, seq = ? WHERE username = ?', (seq, username))
+        else:
+            db.execute('INSERT OR REPLACE INTO locations '
+                       '(username, latitude, longitude, timestamp, district, seq, removed, seen) '
+                       'VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+                       (username, record.latitude, record.longitude, record.timestamp, record.district, seq,
+                        time.time() if seen is None else seen))
+        if (previous is None) != (record is None):
+            db.execute("UPDATE meta SET value = value + ? WHERE key = 'users'", (1 if previous is None else -1,))
+        if _moved(previous, record):
+            transitions.append(self._log_transition(db, username, previous, record))
+            self._count(db, previous.district if previous else None, -1)
+            self._count(db, record.district if record else None, 1)
+        return seq
+
+    def _count(self, db, district, change):
+        if district is not None:
+            db.execute('INSERT INTO occupancy (district, users) VALUES (?, ?) '
+                       'ON CONFLICT (district) DO UPDATE SET users = users + excluded.users',
+                       (district, change))
+
+    def _log_transition(self, db, username, previous, record):
+        entry = _transition(None, username, previous, record)
+        entry['id'] = db.execute(
+            'INSERT INTO transitions (username, from_district, to_district, latitude, longitude, timestamp) '
+            'VALUES (?, ?, ?, ?, ?, ?) RETURNING id',
+            (username, entry['from'], entry['to'], entry['latitude'], entry['longitude'],
+             entry['timestamp'])).fetchone()[0]
+        if entry['id'] % self.TRIM_EVERY == 0:
+            db.execute('DELETE FROM transitions WHERE id <= ?', (entry['id'] - self.transition_log,))
+        return entry
+
+    def _notify(self, transitions, removed=(), seq=None):
+        if transitions and self.on_transitions is not None:
+            self.on_transitions(transitions)
+        if removed and self.on_removed is not None:
+            self.on_removed(removed, seq)
+
+    def _evict_over_cap(self, db, transitions):
+        """Remove the least recently seen users beyond max_users; returns (their names, last seq or None)"""
+        if not self.max_users:
+            return [], None
+        excess = db.execute("SELECT value FROM meta WHERE key = 'users'").fetchone()[0] - self.max_users
+        if excess <= 0:
+            return [], None
+        evicted = [row[0] for row in db.execute(
+            'SELECT username FROM locations WHERE removed = 0 ORDER BY seen LIMIT ?', (excess,))]
+        seq = None
+        for username in evicted:
+            seq = self._write(db, username, None, self._current(db, username), transitions)
+        return evicted, seq
+
+    def put(self, username, record):
+        transitions = []
+        with self._connect().write() as db:
+            seq = self._write(db, username, record, self._current(db, username), transitions)
+            evicted, last = self._evict_over_cap(db, transitions)
+        self._notify(transitions, evicted, last or seq)
+        return last or seq
+
+    def put_many(self, items):
+        seq = None
+        transitions = []
+        with self._connect().write() as db:
+            for username, record in items:
+                seq = self._write(db, username, record, self._current(db, username), transitions)
+            evicted, last = self._evict_over_cap(db, transitions)
+        seq = last or seq
+        self._notify(transitions, evicted, seq)
+        return seq if seq is not None else self.seq
+
+    def replace_if(self, username, expected, record):
+        transitions = []
+        with self._connect().write() as db:
+            # Records read from the database are copies, so compare by value
+            current = self._current(db, username)
+            if current is None or (current.latitude, current.longitude, current.timestamp, current.district) != \
+                    (expected.latitude, expected.longitude, expected.timestamp, expected.district):
+                return None
+            # Reclassifying isn't a report from the user, so keep when they were last seen
+            seen = db.execute('SELECT seen FROM locations WHERE username = ?', (username,)).fetchone()[0]
+            seq = self._write(db, username, record, current, transitions, seen)
+        self._notify(transitions)
+        return seq
+
+    def expire(self, now=None):
+        """
+        Remove users last seen more than ttl seconds before now (default the
+        current time) and trim tombstones; returns how many users were removed.
+        """
+        now = time.time() if now is None else now
+        expired = 0
+        while True:
+            transitions, removed = [], []
+            with self._connect().write() as db:
+                if self.ttl:
+                    removed = [row[0] for row in db.execute(
+                        'SELECT username FROM locations WHERE removed = 0 AND seen < ? ORDER BY seen LIMIT ?',
+                        (now - self.ttl, self.EXPIRE_BATCH))]
+                seq = None
+                for username in removed:
+                    seq = self._write(db, username, None, self._current(db, username), transitions)
+                if len(removed) < self.EXPIRE_BATCH:
+                    self._trim_tombstones(db)
+            self._notify(transitions, removed, seq)
+            expired += len(removed)
+            if len(removed) < self.EXPIRE_BATCH:
+                return expired
+
+    def _trim_tombstones(self, db):
+        """Delete all but the newest max_tombstones removed rows, moving the feed's horizon past them"""
+        row = db.execute('SELECT seq FROM locations WHERE removed = 1 ORDER BY seq DESC LIMIT 1 OFFSET ?',
+                         (self.max_tombstones,)).fetchone()
+        if row:
+            db.execute('DELETE FROM locations WHERE removed = 1 AND seq <= ?', row)
+            db.execute("UPDATE meta SET value = max(value, ?) WHERE key = 'horizon'", row)
+
+    def transitions_since(self, since, username=None, limit=1000):
+        """Same contract as LocationStore.transitions_since"""
+        with self._connect() as db:
+            last, oldest = db.execute('SELECT coalesce(max(id), 0), coalesce(min(id), 0) '
+                                      'FROM transitions').fetchone()
+            if since > last:
+                since = 0
+            query = ('SELECT id, username, from_district, to_district, latitude, longitude, timestamp '
+                     'FROM transitions WHERE id > ?')
+            params = [since]
+            if username is not None:
+                query += ' AND username = ?'
+                params.append(username)
+            rows = db.execute(query + ' ORDER BY id LIMIT ?', params + [limit + 1]).fetchall()
+        found = [dict(zip(('id', 'username', 'from', 'to', 'latitude', 'longitude', 'timestamp'), row))
+                 for row in rows]
+        return _transition_page(last, found, limit, truncated=bool(oldest) and since < oldest - 1)
+
+    def changes_since(self, since, wait=0, bbox=None, district=None):
+        """Same contract as LocationStore.changes_since; waiting polls the database"""
+        filtered = bbox is not None or district is not None
+        deadline = time.monotonic() + wait
+        while wait > 0 and self.seq == since and time.monotonic() < deadline:
+            time.sleep(min(self.POLL_INTERVAL, max(0, deadline - time.monotonic())))
+
+        with self._connect() as db:
+            seq = db.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()[0]
+            # Removals at or before the horizon may have been forgotten
+            horizon = db.execute("SELECT value FROM meta WHERE key = 'horizon'").fetchone()[0]
+            full = since > seq or since < horizon or (filtered and since == 0)
+            rows = [] if full else db.execute('SELECT username, latitude, longitude, timestamp, district, removed '
+                              'FROM locations WHERE seq > ?', (since,)).fetchall()
+        if full:
+            return {'seq': seq, 'full': True, 'changed': self.snapshot(bbox, district), 'removed': []}
+        if filtered:
+            return _filtered_feed(seq, ((row[0], None if row[5] else UserLocation(*row[1:5])) for row in rows),
+                                  bbox, district)
+        changed = {row[0]: UserLocation(*row[1:5]).to_dict() for row in rows if not row[5]}
+        removed = [row[0] for row in rows if row[5]]
+        return {'seq': seq, 'full': False, 'changed': changed, 'removed': removed}
+
+
+class _Transaction:
+    """Wrap a connection so `with` runs a read (deferred) or write (immediate) transaction"""
+
+    def __init__(self, db, write_lock, mode='DEFERRED'):
+        self.db = db
+        self.write_lock = write_lock
+        self.mode = mode
+
+    def write(self):
+        return _Transaction(self.db, self.write_lock, 'IMMEDIATE')
+
+    def __enter__(self):
+        if self.mode == 'IMMEDIATE':
+            self.write_lock.acquire()
+        try:
+            self.db.execute(f'BEGIN {self.mode}')
+        except BaseException:
+            if self.mode == 'IMMEDIATE':
+                self.write_lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            if self.mode == 'IMMEDIATE':
+                self.write_lock.release()
+
+
+def make_location_store(timed_lock=None):
+    """
+    Build the location store selected by the environment.
+
+    LOCATION_DB=<path> shares state between worker processes through SQLite;
+    otherwise users live in this process's memory, sharded LOCATION_SHARDS ways.
+    Either keeps the last TRANSITION_LOG_SIZE district transitions, expires
+    users silent for USER_TTL_SECONDS and holds at most MAX_USERS (0 turns
+    either off), and remembers the last MAX_TOMBSTONES removals for the feed.
+    """
+    path = os.environ.get('LOCATION_DB')
+    limits = {
+        'transition_log': int(os.environ.get('TRANSITION_LOG_SIZE', 10000)),
+        'ttl': float(os.environ.get('USER_TTL_SECONDS', 0)),
+        'max_users': int(os.environ.get('MAX_USERS', 0)),
+        'max_tombstones': int(os.environ.get('MAX_TOMBSTONES', 10000)),
+    }
+    if path:
+        return SqliteLocationStore(path, timed_lock, **limits)
+    return LocationStore(shards=int(os.environ.get('LOCATION_SHARDS', 16)), timed_lock=timed_lock, **limits)
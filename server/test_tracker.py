@@ -0,0 +1,251 @@
+"""
+Tests for the location stores and the district index.
+
+    python -m pytest -q
+
+The stores are checked against each other and against the change-feed
+contract; the index's fast paths (raster, coarse rings, hinted lookups,
+vectorized classify) against a plain first-match point_in_polygon scan.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from geometry import DistrictIndex, point_in_polygon
+from store import LocationStore, SqliteLocationStore, UserLocation
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def fix(district='A', lat=32.7, lng=-117.2):
+    return UserLocation(lat, lng, '2024-01-01T00:00:00', district)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_store(request, tmp_path):
+    """Build a store of the parametrized kind with the given limits"""
+    def make(**limits):
+        if request.param == 'memory':
+            return LocationStore(shards=4, **limits)
+        return SqliteLocationStore(str(tmp_path / 'locations.db'), **limits)
+    return make
+
+
+def clock(store):
+    """The clock a store's expire(now) is measured against"""
+    return time.time() if store.shared else time.monotonic()
+
+
+def state(store):
+    """Everything a reader can see, minus sequence numbers"""
+    transitions = store.transitions_since(0, limit=10000)['transitions']
+    return {
+        'users': store.snapshot(),
+        'counts': store.district_counts(),
+        'transitions': [(t['username'], t['from'], t['to']) for t in transitions],
+        'feed': store.changes_since(0)['changed'],
+    }
+
+
+# Stores
+
+def test_memory_and_sqlite_stores_agree(tmp_path):
+    memory = LocationStore(shards=4, max_users=20)
+    sqlite = SqliteLocationStore(str(tmp_path / 'locations.db'), max_users=20)
+    rng = random.Random(1)
+    for step in range(300):
+        username, other = f'user{rng.randrange(40)}', f'user{rng.randrange(40)}'
+        record = fix(rng.choice('ABC'), rng.uniform(32.6, 32.8), rng.uniform(-117.3, -117.1))
+        for store in (memory, sqlite):
+            if step % 10 == 0:
+                store.put_many([(username, record), (other, record)])
+            elif step % 7 == 0:
+                current = store.get(username)
+                if current is not None:
+                    store.replace_if(username, current, current.with_district('D'))
+            else:
+                store.put(username, record)
+    assert len(memory) == len(sqlite) == 20
+    assert state(memory) == state(sqlite)
+
+
+def test_feed_reports_changes_after_since(make_store):
+    store = make_store()
+    store.put('a', fix())
+    store.put('b', fix())
+    since = store.seq
+    store.put('a', fix('B'))
+
+    feed = store.changes_since(since)
+    assert not feed['full']
+    assert feed['changed'] == {'a': fix('B').to_dict()} and feed['removed'] == []
+    assert feed['seq'] == store.seq > since
+
+    assert store.changes_since(store.seq)['changed'] == {}
+    # A since ahead of the store (e.g. after a restart) gets everything
+    ahead = store.changes_since(store.seq + 100)
+    assert ahead['full'] and set(ahead['changed']) == {'a', 'b'}
+
+
+def test_feed_filters_report_users_leaving_as_removed(make_store):
+    store = make_store()
+    store.put('a', fix('A'))
+    store.put('b', fix('A'))
+    since = store.seq
+    store.put('a', fix('B'))
+    feed = store.changes_since(since, district='A')
+    assert feed['changed'] == {} and feed['removed'] == ['a']
+
+
+def test_evictions_are_tombstones_in_the_feed(make_store):
+    store = make_store(max_users=2)
+    removed = []
+    store.on_removed = lambda usernames, seq: removed.extend(usernames)
+    store.put('a', fix())
+    store.put('b', fix())
+    since = store.seq
+    # Touching a makes b the least recently seen
+    store.put('a', fix())
+    store.put('c', fix())
+
+    assert removed == ['b']
+    assert store.get('b') is None and len(store) == 2
+    feed = store.changes_since(since)
+    assert not feed['full']
+    assert set(feed['changed']) == {'a', 'c'} and feed['removed'] == ['b']
+    # A user who comes back is a change again, not a tombstone
+    store.put('b', fix())
+    assert 'b' in store.changes_since(since)['changed']
+
+
+def test_forgotten_tombstones_force_a_full_feed(make_store):
+    store = make_store(max_users=1, max_tombstones=2)
+    store.put('u0', fix())
+    since = store.seq
+    for i in range(1, 6):
+        store.put(f'u{i}', fix())
+    # SQLite trims tombstones in the expiry sweep
+    store.expire()
+
+    feed = store.changes_since(since)
+    assert feed['full'] and feed['changed'] == {'u5': fix().to_dict()}
+    recent = store.changes_since(store.seq - 2)
+    assert not recent['full'] and recent['removed'] == ['u4']
+
+
+def test_expire_removes_silent_users(make_store):
+    store = make_store(ttl=10)
+    removed = []
+    store.on_removed = lambda usernames, seq: removed.extend(usernames)
+    store.put('a', fix('A'))
+    store.put('b', fix('B'))
+    assert store.expire(clock(store)) == 0
+    assert store.expire(clock(store) + 11) == 2
+    assert sorted(removed) == ['a', 'b'] and len(store) == 0
+    assert store.district_counts() == {}
+    assert [t['to'] for t in store.transitions_since(0)['transitions'][-2:]] == [None, None]
+
+
+def test_lru_cap_holds_under_concurrent_writers(make_store):
+    store = make_store(max_users=50)
+    removed = []
+    store.on_removed = lambda usernames, seq: removed.extend(usernames)
+    written, errors = set(), []
+
+    def write(seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(200):
+                size = rng.randrange(1, 10) if rng.random() < 0.2 else 1
+                batch = [f'user{rng.randrange(200)}' for _ in range(size)]
+                written.update(batch)
+                if len(batch) > 1:
+                    store.put_many([(username, fix(rng.choice('AB'))) for username in batch])
+                else:
+                    store.put(batch[0], fix(rng.choice('AB')))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    users = store.snapshot()
+    assert len(users) == len(store) == 50
+    assert sum(store.district_counts().values()) == 50
+    assert set(store.changes_since(0)['changed']) == set(users)
+    assert all(store.get(username) is not None for username in users)
+    if not store.shared:
+        assert set(store.recency) == set(users)
+    # Every user written and no longer present was announced as removed
+    assert written - set(users) <= set(removed)
+
+
+# District index
+
+def load_map():
+    """The shipped districts plus overlapping triangles, so first-match order matters"""
+    with open(os.path.join(HERE, 'districts.json')) as f:
+        districts = json.load(f)
+    lats = [p[0] for polygon in districts.values() for p in polygon]
+    lngs = [p[1] for polygon in districts.values() for p in polygon]
+    rng = random.Random(2)
+    for i in range(6):
+        lat, lng = rng.uniform(min(lats), max(lats)), rng.uniform(min(lngs), max(lngs))
+        districts[f'Overlap {i}'] = [[lat, lng], [lat + 0.02, lng + 0.005], [lat + 0.004, lng + 0.02]]
+    return districts
+
+
+def sample_points(districts, count=2000):
+    """Random points over the map plus every vertex and edge midpoint"""
+    lats = [p[0] for polygon in districts.values() for p in polygon]
+    lngs = [p[1] for polygon in districts.values() for p in polygon]
+    rng = random.Random(3)
+    points = [(rng.uniform(min(lats) - 0.01, max(lats) + 0.01), rng.uniform(min(lngs) - 0.01, max(lngs) + 0.01))
+              for _ in range(count)]
+    for polygon in districts.values():
+        for a, b in zip(polygon, polygon[1:] + polygon[:1]):
+            points.append((a[0], a[1]))
+            points.append(((a[0] + b[0]) / 2, (a[1] + b[1]) / 2))
+    return points
+
+
+def first_match(districts, lat, lng):
+    return next((name for name, polygon in districts.items() if point_in_polygon(lat, lng, polygon)), None)
+
+
+@pytest.fixture(scope='module')
+def district_map():
+    districts = load_map()
+    points = sample_points(districts)
+    return districts, points, [first_match(districts, lat, lng) for lat, lng in points]
+
+
+@pytest.mark.parametrize('coarse_tolerance, raster_bytes', [
+    (0.0, 0), (0.0001, 0), (0.0, 1 << 16), (0.0001, 1 << 20),
+])
+def test_index_matches_point_in_polygon(district_map, coarse_tolerance, raster_bytes):
+    districts, points, expected = district_map
+    index = DistrictIndex(districts, coarse_tolerance=coarse_tolerance, raster_bytes=raster_bytes)
+    assert (index.raster is not None) == (raster_bytes > 0)
+
+    assert [index.locate(lat, lng)[0] for lat, lng in points] == expected
+    ids = index.classify([lat for lat, _ in points], [lng for _, lng in points])
+    assert [index.names[i] if i >= 0 else None for i in ids] == expected
+
+
+def test_hinted_lookups_keep_first_match(district_map):
+    districts, points, expected = district_map
+    index = DistrictIndex(districts, coarse_tolerance=0.0001)
+    rng = random.Random(4)
+    for (lat, lng), name in zip(points, expected):
+        # The right district, a neighbour or an unrelated one must all give the same answer
+        for hint in {index.positions.get(name), rng.randrange(len(index.names))} - {None}:
+            assert index.locate(lat, lng, hint)[0] == name
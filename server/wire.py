@@ -0,0 +1,89 @@
+JSON = 'application/json'
+POLYLINE = 'application/vnd.locationtracker.polyline+json'
+COLUMNAR = 'application/vnd.locationtracker.columnar+json'
+
+# Coordinates are sent as fixed-point integers of 1e-6 degrees (~11 cm)
+PRECISION = 6
+
+
+def encode_polyline(points, precision=PRECISION):
+    """
+    Encode [lat, lng] points with the encoded-polyline algorithm.
+
+    Each coordinate is rounded to fixed point, delta-encoded against the
+    previous point and written as 5-bit chunks in printable ASCII.
+    """
+    factor = 10 ** precision
+    chunks = []
+    prev_lat = prev_lng = 0
+    for point in points:
+        lat, lng = round(float(point[0]) * factor), round(float(point[1]) * factor)
+        for delta in (lat - prev_lat, lng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lng = lat, lng
+    return ''.join(chunks)
+
+
+def decode_polyline(encoded, precision=PRECISION):
+    """Inverse of encode_polyline"""
+    factor = 10 ** precision
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            result = shift = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append([lat / factor, lng / factor])
+    return points
+
+
+def polyline_districts(districts):
+    """{name: polygon} as {format, precision, districts: {name: encoded}}; unencodable polygons are skipped"""
+    encoded = {}
+    for name, polygon in districts.items():
+        try:
+            encoded[name] = encode_polyline(polygon)
+        except (TypeError, ValueError, OverflowError, IndexError):
+            continue
+    return {'format': 'polyline', 'precision': PRECISION, 'districts': encoded}
+
+
+def columnar_locations(locations):
+    """
+    {username: location dict} as parallel arrays.
+
+    Coordinates are fixed-point integers and districts are indexes into a
+    name table, so each user costs a handful of numbers instead of a keyed
+    object.
+    """
+    factor = 10 ** PRECISION
+    district_ids = {}
+    columns = {'users': [], 'latitude': [], 'longitude': [], 'timestamp': [], 'district': []}
+    for username, location in locations.items():
+        columns['users'].append(username)
+        columns['latitude'].append(_fixed(location['latitude'], factor))
+        columns['longitude'].append(_fixed(location['longitude'], factor))
+        columns['timestamp'].append(location['timestamp'])
+        columns['district'].append(district_ids.setdefault(location['district'], len(district_ids)))
+    return {'format': 'columnar', 'precision': PRECISION, 'districts': list(district_ids), **columns}
+
+
+def _fixed(value, factor):
+    try:
+        return round(float(value) * factor)
+    except (TypeError, ValueError, OverflowError):
+        return None